@@ -9,6 +9,7 @@ class ArbolAdapter:
         Arbol weather contracts using dClimate weather data on IPFS
         and verified contract terms
     '''
+    DEFAULT_ID = '3'
 
     def __init__(self, data):
         ''' Each call to the adapter creates a new Adapter
@@ -16,7 +17,7 @@ class ArbolAdapter:
 
             Parameters: data (dict), the received request body
         '''
-        self.id = data.get('id', '3')
+        self.id = data.get('id', self.DEFAULT_ID)
         self.request_data = data.get('data')
         if self.validate_request_data():
             self.execute_request()
@@ -62,6 +63,7 @@ class ArbolAdapter:
 
             Parameters: result (float), the determined payout value
         '''
+        self.succeeded = True
         self.result = {
             'jobRunID': self.id,
             'data': self.request_data,
@@ -75,6 +77,7 @@ class ArbolAdapter:
 
             Parameters: error (str), associated error message
         '''
+        self.succeeded = False
         self.result = {
             'jobRunID': self.id,
             'data': self.request_data,
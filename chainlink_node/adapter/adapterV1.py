@@ -8,6 +8,7 @@ class ArbolAdapterV1:
     ''' V1 External Adapter class that implements the evaluation and conditional
         executione of Arbol weather contracts based on weather data on IPFS
     '''
+    DEFAULT_ID = '1'
     
     def __init__(self, data):
         ''' Each call to the adapter creates a new Adapter
@@ -15,7 +16,7 @@ class ArbolAdapterV1:
 
             Parameters: data (dict), the received request body
         '''
-        self.id = data.get('id', '1')
+        self.id = data.get('id', self.DEFAULT_ID)
         self.request_data = data.get('data')
         if self.validate_request_data():
             self.execute_request()
@@ -62,6 +63,7 @@ class ArbolAdapterV1:
 
             Parameters: result (float), the determined payout value
         '''
+        self.succeeded = True
         self.result = {
             'jobRunID': self.id,
             'data': self.request_data,
@@ -75,6 +77,7 @@ class ArbolAdapterV1:
 
             Parameters: error (str), associated error message
         '''
+        self.succeeded = False
         self.result = {
             'jobRunID': self.id,
             'data': self.request_data,
@@ -1,13 +1,18 @@
 import sys, os
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'dweather'))
 
-from program_catalog.tools.wrapper import parse_request, get_request_data, operate_on_data
+from program_catalog.tools.aggregation import SOURCE_COMBINATIONS, check_alignment
+from program_catalog.tools.cache import RESPONSE_CACHE
+from program_catalog.tools.executor import CPU_EXECUTOR
+from program_catalog.tools.operations import compile_plan, run_plan
+from program_catalog.tools.wrapper import MULTI_SOURCE_MAX_SOURCES, parse_request, get_request_data, get_multi_source_data
 
 
 class dClimateAdapter:
     ''' External Adapter class for retrieving dClimate weather data on IPFS,
         performing chained operations, and returning the result on chain 
     '''
+    DEFAULT_ID = '2'
 
     def __init__(self, data):
         ''' Each call to the adapter creates a new Adapter
@@ -15,8 +20,11 @@ class dClimateAdapter:
 
             Parameters: input (dict), the received request body
         '''
-        self.id = data.get('id', '2')
+        self.id = data.get('id', self.DEFAULT_ID)
         self.request_data = data.get('data')
+        self.request_error = None
+        self.multi_result = False
+        self.request_combination = None
         self.validate_request_data()
         if self.valid:
             self.execute_request()
@@ -33,12 +41,16 @@ class dClimateAdapter:
             self.valid = False
         else:
             request_url = self.request_data.get('request_url', None)
-            if request_url is None:
+            request_urls = self.request_data.get('request_urls', None)
+            if request_url is None and request_urls is None:
                 self.request_error = 'request_url missing'
                 self.valid =  False
             else:
                 try:
-                    result, valid = parse_request(request_url)
+                    if request_urls is not None:
+                        result, valid = self.parse_sources(request_urls)
+                    else:
+                        result, valid = parse_request(request_url)
                     if not valid:
                         self.request_error = result
                         self.valid = False
@@ -46,32 +58,82 @@ class dClimateAdapter:
                         self.request_args = result
                         self.request_operations = self.request_data.get('request_ops', None)
                         self.request_parameters = self.request_data.get('request_params', [])
+                        self.multi_result = str(self.request_data.get('multi_result', False)).lower() == 'true'
+                        # unsupported operations are rejected here, before any data is fetched
+                        self.request_plan = None
+                        if self.request_operations is not None:
+                            self.request_plan = compile_plan(self.request_operations, self.request_parameters)
                         self.valid = True
+                except ValueError as e:
+                    self.valid = False
+                    self.request_error = str(e)
                 except Exception as e:
                     self.valid = False
-                    self.request_error = e.__name__
+                    self.request_error = type(e).__name__
+
+    def parse_sources(self, request_urls):
+        ''' Parse the request URLs of a multi-source request along with how their
+            series are aligned and combined
+
+            Parameters: request_urls (list), request URLs of the sources
+            Returns: list (or str), endpoint arguments of each source, or an error message
+                     bool, whether the request is valid
+        '''
+        if not isinstance(request_urls, list) or not 2 <= len(request_urls) <= MULTI_SOURCE_MAX_SOURCES:
+            return f'request_urls must list 2 to {MULTI_SOURCE_MAX_SOURCES} request URLs', False
+        self.request_combination = self.request_data.get('request_combine', 'spread')
+        if self.request_combination not in SOURCE_COMBINATIONS:
+            return f'Unsupported combination {self.request_combination}', False
+        self.request_alignment = self.request_data.get('request_align', 'D')
+        if str(self.request_alignment).lower() == 'none':
+            self.request_alignment = None
+        check_alignment(self.request_alignment)
+        sources = []
+        for request_url in request_urls:
+            result, valid = parse_request(request_url)
+            if not valid:
+                return result, False
+            sources.append(result)
+        return sources, True
 
     def execute_request(self):
         ''' Get the designated program and determine whether the associated
             contract should payout and if so then for how much
         '''
         try:
-            result = get_request_data(self.request_args)
-            if self.request_operations is not None:
-                result['data'], msg = operate_on_data(result['data'], self.request_operations, self.request_parameters)
+            # identical requests against the same dataset head are answered from the cache
+            mode = 'multi' if self.multi_result else 'single'
+            if self.request_combination is not None:
+                mode = [mode, self.request_combination, self.request_alignment]
+            cache_key = RESPONSE_CACHE.key(self.request_args, self.request_operations, self.request_parameters, mode)
+            cached = RESPONSE_CACHE.get(cache_key)
+            if cached is not None:
+                self.result_success(dict(cached))
+                return
+            if self.request_combination is not None:
+                result = get_multi_source_data(self.request_args, self.request_combination, self.request_alignment)
+            else:
+                result = get_request_data(self.request_args)
+            if self.request_plan is not None:
+                result['data'], msg = CPU_EXECUTOR.run('operations', run_plan, result['data'], self.request_plan, self.multi_result)
                 if msg is not None:
                     self.request_error = msg
                     self.result_error()
+                    return
             else:
-                if type(result.get('data', None)) is not int:
+                if type(result.get('data', None)) is not (list if self.multi_result else int):
                     self.request_error = 'request operations missing'
+                    self.result_error()
+                    return
             # currently only supporting return values and units, not metadata, snapped cooordinates, etc
-            # also first just one return value at a time (along with unit)
+            # one return value at a time (along with unit), or in multi-result mode a list of values
             # unit is now a failure message if fail, adapter no longer returns 500 response on fail
             payload = {'unit': result.get('unit', 'no unit'), 'data': result['data']}
+            if type(payload['data']) in (int, list):
+                RESPONSE_CACHE.put(cache_key, payload)
             self.result_success(payload)
         except Exception as e:
-            self.request_error = e.__name__
+            self.request_error = type(e).__name__
             self.result_error()
 
     def result_success(self, result):
@@ -80,6 +142,8 @@ class dClimateAdapter:
 
             Parameters: result (float), the determined payout value
         '''
+        # errors are reported with status 200 as well, so success is tracked separately
+        self.succeeded = self.request_error is None
         self.result = {
             'jobRunID': self.id,
             # 'data': self.request_data,
@@ -99,8 +163,9 @@ class dClimateAdapter:
         #     'error': f'There was an error: {error}',
         #     'statusCode': 500,
         # }
+        self.succeeded = False
         self.result = {
             'jobRunID': self.id,
-            'result': {'unit': self.request_error, 'data': 0},
+            'result': {'unit': self.request_error, 'data': [] if self.multi_result else 0},
             'statusCode': 200,
         }
\ No newline at end of file
@@ -2,7 +2,49 @@ from flask import Flask, request, jsonify
 
 from adapterV1 import ArbolAdapterV1
 from adapter import ArbolAdapter
+from batch import ArbolBatchAdapter
 from api import dClimateAdapter
+from program_catalog.tools.bridge import BRIDGE
+from program_catalog.tools.cache import DATASET_HEADS, FETCHES, RESPONSE_CACHE
+from program_catalog.tools.crypto import TERMS_CACHE, key_context
+from program_catalog.tools.executor import CPU_EXECUTOR
+from program_catalog.tools.wrapper import ROUTER
+from program_catalog.tools.indices import PREFIX_SUMS, STATION_INDEXES
+from program_catalog.tools.ledger import LEDGER
+
+
+def run_adapter(adapter_class, data):
+    ''' Runs a request on a new adapter instance
+
+        Returns: dict, the adapter result
+                 bool, whether the adapter reported success
+    '''
+    adapter = adapter_class(data)
+    return adapter.result, getattr(adapter, 'succeeded', False)
+
+
+def respond(adapter_class, data):
+    ''' Runs a request on an adapter, in the background if the node asked for an
+        async response with a responseURL and there is room on the bridge pool.
+        Retries of a job run are served its recorded result or, while it is still
+        running, wait on it (or are acknowledged again if it runs in the background)
+
+        Parameters: adapter_class (class), adapter computing the result in its constructor
+                    data (dict), the received request body
+        Returns: dict, the adapter result or a pending acknowledgement
+    '''
+    key = LEDGER.key(adapter_class, data)
+    result = LEDGER.get(key)
+    if result is not None:
+        return result
+    compute = lambda: LEDGER.run(key, lambda: run_adapter(adapter_class, data))
+    if BRIDGE.accepts(data):
+        if LEDGER.in_flight(key):
+            return BRIDGE.pending(adapter_class, data)
+        pending = BRIDGE.submit(adapter_class, data, compute)
+        if pending is not None:
+            return pending
+    return compute()
 
 
 def build_app():
@@ -21,8 +63,17 @@ def build_app():
         data = request.get_json()
         if data == '':
             data = {}
-        response = ArbolAdapter(data)
-        return jsonify(response.result)
+        return jsonify(respond(ArbolAdapter, data))
+
+    @app.route('/batch', methods=['POST'])
+    def call_batch_adapter():
+        ''' Route for evaluating many NFT contracts in one request, loading
+            each distinct history once
+        '''
+        data = request.get_json()
+        if data == '':
+            data = {}
+        return jsonify(respond(ArbolBatchAdapter, data))
 
     @app.route('/v1', methods=['POST'])
     def call_v1_adapter():
@@ -32,8 +83,7 @@ def build_app():
         data = request.get_json()
         if data == '':
             data = {}
-        response = ArbolAdapterV1(data)
-        return jsonify(response.result)    
+        return jsonify(respond(ArbolAdapterV1, data))    
 
     @app.route('/api', methods=['POST'])
     def call_api_adapter():
@@ -41,8 +91,7 @@ def build_app():
         data = request.get_json()
         if data == '':
             data = {}
-        response = dClimateAdapter(data)
-        return jsonify(response.result)
+        return jsonify(respond(dClimateAdapter, data))
     
     @app.route('/health', methods=['POST'])
     def health_check():
@@ -53,6 +102,24 @@ def build_app():
         }
         return jsonify(healthy)
 
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        ''' Cache counters for this worker '''
+        stats = {
+            'dataset_heads': DATASET_HEADS.stats(),
+            'ipfs_fetches': FETCHES.stats(),
+            'prefix_sums': PREFIX_SUMS.stats(),
+            'station_indexes': STATION_INDEXES.stats(),
+            'decrypted_terms': TERMS_CACHE.stats(),
+            'key_derivations': key_context().stats(),
+            'cpu_stages': CPU_EXECUTOR.stats(),
+            'parsed_urls': ROUTER.stats(),
+            'api_responses': RESPONSE_CACHE.stats(),
+            'async_bridge': BRIDGE.stats(),
+            'job_runs': LEDGER.stats(),
+        }
+        return jsonify(stats)
+
 
         
 
@@ -0,0 +1,117 @@
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'dweather'))
+
+from program_catalog.directory import parse_and_validate
+
+
+class ArbolBatchAdapter:
+    ''' External Adapter class for evaluating many Arbol NFT contracts in one
+        request. Contracts that share a dataset, location set and coverage window
+        are grouped so that each distinct history is loaded once
+    '''
+    DEFAULT_ID = '4'
+
+    def __init__(self, data):
+        ''' Each call to the adapter creates a new Adapter
+            instance to handle the request
+
+            Parameters: data (dict), the received request body
+        '''
+        self.id = data.get('id', self.DEFAULT_ID)
+        self.request_data = data.get('data')
+        if self.validate_request_data():
+            self.execute_request()
+        else:
+            self.result_error(self.request_error)
+
+    def validate_request_data(self):
+        ''' Validate that the received request holds a non-empty list of evaluation
+            payloads, each formatted as the request data of a single evaluation
+        '''
+        if self.request_data is None or self.request_data == {}:
+            self.request_error = 'request data empty'
+            return False
+        self.requests = self.request_data.get('requests', None)
+        if not isinstance(self.requests, list) or len(self.requests) == 0:
+            self.request_error = 'requests missing'
+            return False
+        return True
+
+    def execute_request(self):
+        ''' Decrypts and validates each payload, groups the valid ones by the
+            history they are evaluated against, loads each history once and
+            evaluates every contract in the group against it
+        '''
+        results = [None] * len(self.requests)
+        groups = {}
+        for i, request_data in enumerate(self.requests):
+            if not isinstance(request_data, dict):
+                results[i] = {'error': 'There was an error: request data must be an object'}
+                continue
+            parameters, program = parse_and_validate(request_data)
+            if program is None:
+                results[i] = {'error': f'There was an error: {parameters}'}
+                continue
+            try:
+                key = (program, program.history_key(parameters)) if hasattr(program, 'history_key') else (program, i)
+            except Exception as e:
+                results[i] = {'error': f'There was an error: {e}'}
+                continue
+            groups.setdefault(key, []).append((i, parameters))
+
+        print(f'evaluating {len(self.requests)} requests in {len(groups)} groups', flush=True)
+        for (program, _), members in groups.items():
+            if not hasattr(program, 'load_history'):
+                for i, parameters in members:
+                    results[i] = self._evaluate(program.serve_request, parameters)
+                continue
+            try:
+                history = program.load_history(members[0][1])
+            except Exception as e:
+                for i, _ in members:
+                    results[i] = {'error': f'There was an error: {e}'}
+                continue
+            for i, parameters in members:
+                results[i] = self._evaluate(lambda params: program.evaluate(history, params), parameters)
+        self.result_success(results)
+
+    @staticmethod
+    def _evaluate(evaluate, parameters):
+        ''' Evaluates a single contract, capturing any error as its result
+
+            Parameters: evaluate (function), computes the result from the parameters
+                        parameters (dict), parsed contract parameters
+            Returns: dict, the result or error for the contract
+        '''
+        try:
+            return {'result': evaluate(parameters)}
+        except Exception as e:
+            return {'error': f'There was an error: {e}'}
+
+    def result_success(self, result):
+        ''' If the request reaches no errors log the outcome in the result field
+            including the per-contract results in the response
+
+            Parameters: result (list), result or error for each request in order
+        '''
+        # a failed contract may succeed on a retry, so only complete batches count as successful
+        self.succeeded = not any('error' in entry for entry in result)
+        self.result = {
+            'jobRunID': self.id,
+            'result': result,
+            'statusCode': 200,
+        }
+
+    def result_error(self, error):
+        ''' If the request terminates in an error then log the error details in
+            the result field to be returned in the response
+
+            Parameters: error (str), associated error message
+        '''
+        self.succeeded = False
+        self.result = {
+            'jobRunID': self.id,
+            'data': self.request_data,
+            'error': f'There was an error: {error}',
+            'statusCode': 500,
+        }
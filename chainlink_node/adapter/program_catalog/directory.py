@@ -1,6 +1,6 @@
 from program_catalog.programs.rainfall_derivative import RainfallDerivative
 from program_catalog.programs.critical_snowfall_derivative import CriticalSnowfallDerivative
-from program_catalog.tools.crypto import Reencryption, decrypt
+from program_catalog.tools.crypto import BulkReencryption, Reencryption, decrypt
 from program_catalog.tools.loaders import parse_timestamp
 
 
@@ -22,7 +22,14 @@ def get_parameters_and_program(request_data):
         return 'job type (reencryption, evaluation) missing', None
     elif job_type == "reencryption":
         print(f'reencryption job node key {node_key}', flush=True)
-        # reencryption job requires public key of new viewer
+        # reencryption job requires public key of new viewer, or public keys of many viewers
+        public_keys = request_data.get('viewerAddressPublicKeys', None)
+        if public_keys is not None:
+            parameters = {
+                "node_key": node_key,
+                "public_keys": public_keys
+            }
+            return parameters, BulkReencryption
         public_key = request_data.get('viewerAddressPublicKey', None)
         if public_key is None:
             return 'public key missing', None
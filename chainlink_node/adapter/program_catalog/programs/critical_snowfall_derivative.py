@@ -1,4 +1,6 @@
 # from datetime import datetime
+import numpy as np
+import pandas as pd
 
 from program_catalog.tools.loaders import StationLoader
 
@@ -54,14 +56,97 @@ class CriticalSnowfallDerivative:
                                     dataset_name=params['dataset'],
                                     imperial_units=params.get('imperial_units', True)
                                     )
-        covered_history = loader.load()
-        payout = cls._generate_payouts(data=covered_history,
+        index_value = loader.max_over_dates()
+        payout = cls._payout_for_index(index_value, params['threshold'], params['opt_type'], params['limit'])
+        return payout
+        # return 0
+
+    @classmethod
+    def history_key(cls, params):
+        ''' Identifies the history a contract is evaluated against, so that contracts
+            sharing a station, weather variable and covered dates can share one load
+
+            Parameters: params (dict), dictionary of required contract parameters
+            Returns: tuple, hashable key of the dataset, station and covered dates
+        '''
+        return (cls.__name__, params['dataset'], params['station_id'], params['weather_variable'],
+                str(params['dates']), str(params.get('imperial_units', True)))
+
+    @classmethod
+    def load_history(cls, params):
+        ''' Loads the station weather data for the covered dates
+
+            Parameters: params (dict), dictionary of required contract parameters
+            Returns: Pandas Series, time series of station weather data for covered dates
+        '''
+        loader = StationLoader(params['dates'],
+                                    params['station_id'],
+                                    params['weather_variable'],
+                                    dataset_name=params['dataset'],
+                                    imperial_units=params.get('imperial_units', True)
+                                    )
+        return loader.load()
+
+    @classmethod
+    def evaluate(cls, history, params):
+        ''' Computes the payout for a contract from its loaded history
+
+            Parameters: history (Pandas Series), station weather data for covered dates
+                        params (dict), dictionary of required contract parameters
+            Returns: number, the determined payout (0 if not awarded)
+        '''
+        payout = cls._generate_payouts(data=history,
                                         threshold=params['threshold'],
                                         opt_type=params['opt_type'],
                                         limit=params['limit'],
                                         )
         return payout
-        # return 0
+
+    @classmethod
+    def backtest(cls, params):
+        ''' Computes what a contract would have paid in every year of the station
+            history by shifting its covered dates across all years that the history
+            fully covers. The history is indexed once by day (days with several
+            observations keep their maximum) and the covered dates of every year are
+            reduced with the index in one pass, as a settlement would reduce them
+
+            Parameters: params (dict), dictionary of required contract parameters
+            Returns: Pandas DataFrame, index value and payout (times the output
+            multiplier) for each year, indexed by the year of the first covered date
+        '''
+        loader = StationLoader(params['dates'],
+                                    params['station_id'],
+                                    params['weather_variable'],
+                                    dataset_name=params['dataset'],
+                                    imperial_units=params.get('imperial_units', True)
+                                    )
+        index = loader.load_index()
+        dates = pd.to_datetime(pd.Series(loader.dates, dtype=str), format='%Y-%m-%d')
+        if len(dates) == 0:
+            raise ValueError('no covered dates')
+        first, last = index.span
+        first_year, last_year = (np.array([first, last], dtype='datetime64[D]').astype('datetime64[Y]').astype('<i8') + 1970)
+        offsets = np.arange(first_year - dates.dt.year.min(), last_year - dates.dt.year.max() + 1)
+
+        # shift every covered date by every year offset at once, dropping dates that do not exist (Feb 29)
+        shifted = pd.to_datetime(pd.DataFrame({
+            'year': (dates.dt.year.values[None, :] + offsets[:, None]).ravel(),
+            'month': np.tile(dates.dt.month.values, len(offsets)),
+            'day': np.tile(dates.dt.day.values, len(offsets)),
+        }), errors='coerce')
+        exists = shifted.notna().values.reshape(len(offsets), len(dates))
+        days = shifted.values.astype('datetime64[D]').view('<i8').reshape(len(offsets), len(dates))
+
+        # years with a covered date missing from the history come back as NaN and are dropped
+        maxima = index.max_over_rows(days, exists)
+        covered = ~np.isnan(maxima) & exists.any(axis=1)
+        if not covered.any():
+            raise ValueError('history does not cover the covered dates in any year')
+        years = dates.dt.year.min() + offsets[covered]
+        index_values = maxima[covered]
+
+        payouts = cls.generate_payouts(index_values, params['threshold'], params['opt_type'], params['limit'])
+        return pd.DataFrame({'index_value': index_values, 'payout': payouts}, index=pd.Index(years, name='year'))
 
     @classmethod
     def _generate_payouts(cls, data, threshold, opt_type, limit):
@@ -79,17 +164,38 @@ class CriticalSnowfallDerivative:
             N.B.1 Adding change to cut threshold from 6 to 3 inches [01-20-2022]
             N.B.3.2 Undoing changes after conclusion                [05-13-2022]
         '''
-        threshold = float(threshold) #/ 2
+        index_value = data.max().value
+        return cls._payout_for_index(index_value, threshold, opt_type, limit)
 
-        limit = float(limit)
+    @classmethod
+    def _payout_for_index(cls, index_value, threshold, opt_type, limit):
+        ''' Calculates the payout for a single contract from its index value
 
-        index_value = data.max().value
-        opt_type = opt_type.lower()
-        direction = 1 if opt_type == 'call' else -1
-        
-        payout = (index_value - threshold) * direction
-        if payout < 0:
-            payout = 0
-        if payout > 0:
-            payout = limit
-        return int(payout * cls._OUTPUT_MULTIPLIER)
\ No newline at end of file
+            Parameters: index_value (float), maximum weather value over the covered dates
+                        remaining parameters as for _generate_payouts
+            Returns: int, generated payout times 10^6 (in order to report back to chain in value of USDC)
+        '''
+        return int(cls.generate_payouts(index_value, threshold, opt_type, limit)[0])
+
+    @classmethod
+    def generate_payouts(cls, index_values, threshold, opt_type, limit):
+        ''' Computes payouts for any number of index values and contract terms in one
+            vectorized pass, broadcasting all arguments against each other. A payout is
+            the full limit whenever the index is past the threshold in the direction
+            of the option and 0 otherwise
+
+            Parameters: index_values (number or array), maximum weather values over covered dates
+                        threshold (number, str or array), weather variable thresholds in inches
+                        opt_type (str or array), type of option contract, either PUT or CALL
+                        limit (number, str or array), limit values for the payouts
+            Returns: numpy array, int64 payouts times the output multiplier
+        '''
+        threshold = np.asarray(threshold, dtype='<f8') #/ 2
+        limit = np.asarray(limit, dtype='<f8')
+        direction = np.where(np.char.lower(np.asarray(opt_type, dtype=str)) == 'call', 1.0, -1.0)
+
+        payout = np.atleast_1d((np.asarray(index_values, dtype='<f8') - threshold) * direction)
+        if np.isnan(payout).any():
+            raise ValueError('cannot convert float NaN to integer')
+        payout = np.where(payout > 0, np.broadcast_to(limit, payout.shape), 0.0)
+        return (payout * cls._OUTPUT_MULTIPLIER).astype('<i8')
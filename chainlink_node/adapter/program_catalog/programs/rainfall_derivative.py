@@ -1,5 +1,10 @@
 # from datetime import datetime
+import ast
+import numpy as np
+import pandas as pd
 
+from program_catalog.tools.cache import get_head
+from program_catalog.tools.indices import PREFIX_SUMS, PrefixSumIndex
 from program_catalog.tools.loaders import GridcellLoader
 
 
@@ -45,12 +50,94 @@ class RainfallDerivative:
             Parameters: params (dict), dictionary of required contract parameters
             Returns: number, the determined payout (0 if not awarded)
         '''
+        identity = cls.series_identity(params)
+        head = get_head(params['dataset'])
+        index = PREFIX_SUMS.get(identity, head)
+        if index is not None:
+            index_value = index.window_sum(params['start'], params['end'])
+            return cls._payout_for_index(index_value, **cls._payout_terms(params))
+        if PREFIX_SUMS.get_stale(identity, head) is not None:
+            # settle from the coverage window and bring the index up to date off the request path
+            PREFIX_SUMS.refresh(identity, lambda: cls.load_prefix_sums(params))
+        avg_history = cls.load_history(params)
+        payout = cls.evaluate(avg_history, params)
+        return payout
+
+    @classmethod
+    def series_identity(cls, params):
+        ''' Identifies the averaged series a contract is evaluated against. Locations
+            are kept in request order, as the average is accumulated in that order
+
+            Parameters: params (dict), dictionary of required contract parameters
+            Returns: tuple, hashable key of the dataset and location list
+        '''
+        locations = params['locations']
+        if type(locations) == str:
+            locations = ast.literal_eval(locations)
+        locations = tuple((float(lat), float(lon)) for (lat, lon) in locations)
+        return (cls.__name__, params['dataset'], locations)
+
+    @classmethod
+    def history_key(cls, params):
+        ''' Identifies the history a contract is evaluated against, so that contracts
+            sharing a dataset, location set and coverage period can share one load
+
+            Parameters: params (dict), dictionary of required contract parameters
+            Returns: tuple, hashable key of the dataset, locations and coverage period
+        '''
+        return cls.series_identity(params) + (params['start'], params['end'])
+
+    @classmethod
+    def load_prefix_sums(cls, params):
+        ''' Gets the cached prefix sum index of the averaged history of the contract
+            locations. An index built from an older dataset head is extended with the
+            history loaded from its last date onwards; the full history is only loaded
+            if there is no such index or the newer head changed past values
+
+            Parameters: params (dict), dictionary of required contract parameters
+            Returns: PrefixSumIndex, window sum index of the averaged history
+        '''
+        identity = cls.series_identity(params)
+        head = get_head(params['dataset'])
+        index = PREFIX_SUMS.get(identity, head)
+        if index is not None:
+            return index
+        stale = PREFIX_SUMS.get_stale(identity, head)
+        if stale is not None:
+            index = stale.extend(cls._load_averaged(params, window=(stale.bounds[1], None)))
+        if index is None:
+            index = PrefixSumIndex.from_series(cls._load_averaged(params))
+        PREFIX_SUMS.put(identity, head, index)
+        return index
+
+    @classmethod
+    def _load_averaged(cls, params, window=None):
+        ''' Returns: Pandas Series, weather data averaged over the contract locations within the window '''
         loader = GridcellLoader(params['locations'],
                                 params['dataset'],
-                                imperial_units=True         # force imperial units = true
+                                imperial_units=True,        # force imperial units = true
+                                window=window
                                 )
-        avg_history = loader.load()
-        payout = cls._generate_payouts(data=avg_history,
+        return loader.load()
+
+    @classmethod
+    def load_history(cls, params):
+        ''' Loads the weather data averaged over the contract locations for the coverage period
+
+            Parameters: params (dict), dictionary of required contract parameters
+            Returns: Pandas Series, time series of weather data averaged over locations
+        '''
+        return cls._load_averaged(params, window=(params['start'], params['end']))
+
+    @classmethod
+    def evaluate(cls, history, params):
+        ''' Computes the payout for a contract from its loaded history
+
+            Parameters: history (Pandas Series), weather data averaged over locations
+                        params (dict), dictionary of required contract parameters
+            Returns: number, the determined payout (0 if not awarded)
+        '''
+        payout = cls._generate_payouts(data=history,
                                         start=params['start'],
                                         end=params['end'],
                                         opt_type=params['opt_type'],
@@ -61,6 +148,42 @@ class RainfallDerivative:
                                         )
         return payout
 
+    @classmethod
+    def backtest(cls, params):
+        ''' Computes what a contract would have paid in every year of the dataset
+            history by shifting its coverage period across all years that the
+            history fully covers. The history is loaded once and the index for
+            every year is read from its cached prefix sums
+
+            Parameters: params (dict), dictionary of required contract parameters
+            Returns: Pandas DataFrame, index value and payout (times the output
+            multiplier) for each year, indexed by the year coverage starts in
+        '''
+        index = cls.load_prefix_sums(params)
+        start, end = (pd.Timestamp(date) for date in (params['start'], params['end']))
+        first, last = index.bounds
+
+        years, starts, ends = [], [], []
+        for offset in range(first.year - start.year - 1, last.year - end.year + 1):
+            shifted_start = start + pd.DateOffset(years=offset)
+            shifted_end = end + pd.DateOffset(years=offset)
+            if shifted_start >= first and shifted_end <= last:
+                years.append(shifted_start.year)
+                starts.append(shifted_start.to_datetime64())
+                ends.append(shifted_end.to_datetime64())
+        if len(years) == 0:
+            raise ValueError('history does not cover the coverage period in any year')
+
+        index_values = index.window_sums(np.array(starts, dtype='datetime64[ns]'), np.array(ends, dtype='datetime64[ns]'))
+        payouts = cls.generate_payouts(index_values,
+                                        params['opt_type'],
+                                        params['strike'],
+                                        params['limit'],
+                                        exhaust=params.get('exhaust', None),
+                                        tick=params.get('tick', None)
+                                        )
+        return pd.DataFrame({'index_value': index_values, 'payout': payouts}, index=pd.Index(years, name='year'))
+
     @classmethod
     def _generate_payouts(cls, data, start, end, opt_type, strike, limit, exhaust, tick):
         ''' Uses the provided contract parameters to calculate a payout and index
@@ -76,39 +199,79 @@ class RainfallDerivative:
                         tick (str), tick value for payout or None if exhaust is not None
             Returns: int, generated payout times 10^8 (in order to report back to chain)
         '''
-        print(f'data: {data}', flush=True)
-        print(f'start: {start}', flush=True)
-        print(f'end: {end}', flush=True)
+        index_value = data.loc[start:end].sum()
+        return cls._payout_for_index(index_value, start, end, opt_type, strike, limit, exhaust, tick)
 
-        strike = float(strike)
-        limit = float(limit)
+    @classmethod
+    def _payout_terms(cls, params):
+        ''' Returns: dict, the contract terms used to compute a payout from an index value '''
+        return {
+            'start': params['start'],
+            'end': params['end'],
+            'opt_type': params['opt_type'],
+            'strike': params['strike'],
+            'limit': params['limit'],
+            'exhaust': params.get('exhaust', None),
+            'tick': params.get('tick', None),
+        }
 
-        print(f'strike: {strike}', flush=True)
-        print(f'limit: {limit}', flush=True)
+    @classmethod
+    def _payout_for_index(cls, index_value, start, end, opt_type, strike, limit, exhaust, tick):
+        ''' Calculates the payout for a single contract from its index value
 
-        index_value = data.loc[start:end].sum()
-        opt_type = opt_type.lower()
-        direction = 1 if opt_type == 'call' else -1
-
-        print(f'index_value: {index_value}', flush=True)
-        print(f'opt_type: {opt_type}', flush=True)
-        print(f'direction: {direction}', flush=True)
-
-        print(f'exhaust: {exhaust}', flush=True)
-        print(f'tick: {tick}', flush=True)
-        if tick is not None:
-            tick = float(tick)
-        else:
-            exhaust = float(exhaust)
-            tick = abs(limit / (strike - exhaust))
-        print(f'exhaust: {exhaust}', flush=True)
-        print(f'tick: {tick}', flush=True)
-
-        payout = (index_value - strike) * tick * direction
-        print(f'payout: {payout}', flush=True)
-        if payout < 0:
-            payout = 0
-        if payout > limit:
-            payout = limit
-        print(f'result: {int(float(round(payout, 2)) * cls._OUTPUT_MULTIPLIER)}', flush=True)
-        return int(float(round(payout, 2)) * cls._OUTPUT_MULTIPLIER)
+            Parameters: index_value (float), sum of the weather data over the coverage period
+                        remaining parameters as for _generate_payouts
+            Returns: int, generated payout times 10^8 (in order to report back to chain)
+        '''
+        payout = cls.generate_payouts(index_value, opt_type, strike, limit, exhaust=exhaust, tick=tick)
+        result = int(payout[0])
+        print(f'start: {start}, end: {end}, index_value: {index_value}, opt_type: {opt_type}, strike: {strike}, '
+              f'limit: {limit}, exhaust: {exhaust}, tick: {tick}, result: {result}', flush=True)
+        return result
+
+    @classmethod
+    def generate_payouts(cls, index_values, opt_type, strike, limit, exhaust=None, tick=None):
+        ''' Computes payouts for any number of contract terms and index values in one
+            vectorized pass. All arguments are broadcast against each other, so a book
+            of terms can be priced against one index value or one set of terms against
+            many index values
+
+            Clipping and rounding match evaluating each contract on its own: payouts
+            are floored at 0 and capped at the limit, unclipped payouts are rounded
+            to cents as a float64, capped payouts are rounded as the float limit and
+            the result is truncated after scaling to the output multiplier
+
+            Parameters: index_values (number or array), float64 index values
+                        opt_type (str or array), type of option contract, either PUT or CALL
+                        strike (number, str or array), strike values for the payouts
+                        limit (number, str or array), limit values for the payouts
+                        exhaust (number, str or array), exhaust values for the payouts,
+            used wherever tick is None or NaN
+                        tick (number, str or array), tick values for the payouts or None
+            Returns: numpy array, int64 payouts times the output multiplier
+        '''
+        index_values = np.asarray(index_values, dtype='<f8')
+        strike = np.asarray(strike, dtype='<f8')
+        limit = np.asarray(limit, dtype='<f8')
+        direction = np.where(np.char.lower(np.asarray(opt_type, dtype=str)) == 'call', 1.0, -1.0)
+        tick = np.asarray(np.nan if tick is None else tick, dtype='<f8')
+        if np.isnan(tick).any():
+            if exhaust is None:
+                raise ValueError('exhaust is required where tick is not given')
+            exhaust = np.asarray(exhaust, dtype='<f8')
+            spread = np.broadcast_to(strike - exhaust, np.broadcast(strike, exhaust, tick).shape)
+            if (spread[np.isnan(np.broadcast_to(tick, spread.shape))] == 0).any():
+                raise ZeroDivisionError('float division by zero')
+            with np.errstate(divide='ignore', invalid='ignore'):
+                tick = np.where(np.isnan(tick), np.abs(limit / (strike - exhaust)), tick)
+
+        payout = np.atleast_1d((index_values - strike) * tick * direction)
+        if np.isnan(payout).any():
+            raise ValueError('cannot convert float NaN to integer')
+        limit = np.broadcast_to(limit, payout.shape)
+        payout = np.where(payout < 0, 0.0, payout)
+        capped = payout > limit
+        rounded = np.round(payout, 2)
+        if capped.any():
+            rounded[capped] = [round(float(value), 2) for value in limit[capped]]
+        return (rounded * cls._OUTPUT_MULTIPLIER).astype('<i8')
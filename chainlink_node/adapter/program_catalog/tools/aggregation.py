@@ -0,0 +1,251 @@
+import numpy as np
+import pandas as pd
+
+
+def as_arrays(series):
+    ''' Splits a time series into int64 nanosecond UTC timestamps and float values
+
+        Parameters: series (Pandas Series), time series with a sorted DatetimeIndex
+        Returns: numpy array, int64 nanosecond timestamps (UTC if the index is timezone-aware)
+                 numpy array, float64 values
+                 tzinfo, timezone of the index or None if it is naive
+    '''
+    index = series.index
+    tz = index.tz
+    if tz is not None:
+        index = index.tz_convert('UTC').tz_localize(None)
+    times = index.values.astype('datetime64[ns]', copy=False).view('<i8')
+    return times, float_values(series), tz
+
+
+def float_values(series):
+    ''' Gets the values of a series as floats, taking the magnitude of unit quantities
+
+        Parameters: series (Pandas Series), series of numbers or of unit quantities
+        Returns: numpy array, float64 values
+    '''
+    values = series.values
+    if values.dtype == object and len(values) > 0 and hasattr(values[0], 'unit'):
+        return np.array([value.value for value in values], dtype='<f8')
+    return np.asarray(values, dtype='<f8')
+
+
+def as_series(times, values, tz):
+    ''' Rebuilds a time series from int64 nanosecond timestamps and float values
+
+        Parameters: times (numpy array), int64 nanosecond timestamps
+                    values (numpy array), float64 values
+                    tz (tzinfo), timezone to convert the index to or None if naive
+        Returns: Pandas Series, the time series
+    '''
+    index = pd.DatetimeIndex(times.view('datetime64[ns]'))
+    if tz is not None:
+        index = index.tz_localize('UTC').tz_convert(tz)
+    return pd.Series(values, index=index)
+
+
+def _positions(times, series_times):
+    ''' Locates the timestamps of a series on a sorted time axis, taking the fast path
+        of a contiguous run (histories of the same dataset usually differ only in
+        where they start or end) before falling back to a binary search
+
+        Parameters: times (numpy array), sorted int64 timestamps of the time axis
+                    series_times (numpy array), sorted int64 timestamps of a series
+        Returns: slice or numpy array, positions of the series timestamps on the
+        time axis or None if not all of them are on it
+    '''
+    if len(series_times) == 0:
+        return slice(0, 0)
+    first = int(np.searchsorted(times, series_times[0]))
+    run = slice(first, first + len(series_times))
+    if np.array_equal(times[run], series_times):
+        return run
+    positions = np.searchsorted(times, series_times)
+    if positions[-1] >= len(times) or not np.array_equal(times[positions], series_times):
+        return None
+    return positions
+
+
+def average_series(histories, weights=None):
+    ''' Computes the NaN-aware (weighted) average of a number of time series.
+        The time axes are aligned once onto their sorted union and each series is
+        accumulated into preallocated running sum and count buffers, avoiding the
+        wide intermediate DataFrame of pd.concat(axis=1).mean(axis=1)
+
+        Parameters: histories (list), Pandas Series with sorted, unique DatetimeIndexes
+                    weights (list), optional weight for each series (defaults to 1)
+        Returns: Pandas Series, time series of averages over the union of the
+        time axes, NaN wherever no series has a value
+    '''
+    if weights is None:
+        weights = [1] * len(histories)
+    arrays = [as_arrays(series) for series in histories]
+    times = arrays[0][0]
+    for series_times, _, _ in arrays[1:]:
+        if _positions(times, series_times) is None:
+            times = np.union1d(times, series_times)
+
+    total = np.zeros(len(times), dtype='<f8')
+    count = np.zeros(len(times), dtype='<f8')
+    for (series_times, values, _), weight in zip(arrays, weights):
+        _accumulate(total, count, _positions(times, series_times), values, weight)
+    return as_series(times, _divide(total, count), arrays[0][2])
+
+
+def _accumulate(total, count, positions, values, weight):
+    ''' Adds the non-NaN values of a series and their weights into running buffers in place
+
+        Parameters: total (numpy array), running weighted sum of values
+                    count (numpy array), running sum of weights of non-NaN values
+                    positions (slice or numpy array), positions of the values in the buffers
+                    values (numpy array), float64 values of the series
+                    weight (number), weight of the series
+    '''
+    present = ~np.isnan(values)
+    filled = np.where(present, values, 0)
+    if weight != 1:
+        filled *= weight
+        present = present * weight
+    total[positions] += filled
+    count[positions] += present
+
+
+def _divide(total, count):
+    ''' Returns: numpy array, the average of the running buffers, NaN where the count is 0 '''
+    with np.errstate(invalid='ignore', divide='ignore'):
+        average = total / count
+    average[count == 0] = np.nan
+    return average
+
+
+class RunningAverage:
+    ''' Streaming NaN-aware (weighted) average of time series. Each series is folded
+        into running sum and count buffers as it arrives so it can be released
+        straight away; the buffers are only regrown when a series has timestamps
+        not yet on the time axis
+    '''
+    def __init__(self):
+        self._times = None
+        self._total = None
+        self._count = None
+        self._tz = None
+
+    def add(self, series, weight=1):
+        ''' Folds a series into the running average
+
+            Parameters: series (Pandas Series), time series with a sorted, unique DatetimeIndex
+                        weight (number), weight of the series
+        '''
+        times, values, tz = as_arrays(series)
+        if self._times is None:
+            self._times = times.copy()
+            self._total = np.zeros(len(times), dtype='<f8')
+            self._count = np.zeros(len(times), dtype='<f8')
+            self._tz = tz
+        positions = _positions(self._times, times)
+        if positions is None:
+            self._grow(times)
+            positions = _positions(self._times, times)
+        _accumulate(self._total, self._count, positions, values, weight)
+
+    def result(self):
+        ''' Returns: Pandas Series, time series of averages of all series added so far '''
+        if self._times is None:
+            raise ValueError('No data returned for request')
+        return as_series(self._times, _divide(self._total, self._count), self._tz)
+
+    def _grow(self, times):
+        ''' Extends the time axis with new timestamps and moves the buffers onto it
+
+            Parameters: times (numpy array), sorted int64 timestamps to add
+        '''
+        union = np.union1d(self._times, times)
+        old_positions = np.searchsorted(union, self._times)
+        total = np.zeros(len(union), dtype='<f8')
+        count = np.zeros(len(union), dtype='<f8')
+        total[old_positions] = self._total
+        count[old_positions] = self._count
+        self._times, self._total, self._count = union, total, count
+
+
+# how the aligned series of a multi-source request are combined into one series,
+# spread and ratio take exactly two sources (first minus or over second)
+SOURCE_COMBINATIONS = frozenset(['spread', 'ratio', 'sum', 'mean', 'max', 'min'])
+
+
+def check_alignment(freq):
+    ''' Checks that a frequency can be used to align the series of a multi-source request
+
+        Parameters: freq (str), Pandas frequency or None
+        Raises: ValueError, if the frequency is not a Pandas frequency
+    '''
+    if freq is None:
+        return
+    try:
+        pd.tseries.frequencies.to_offset(freq)
+    except (ValueError, TypeError):
+        raise ValueError(f'Unsupported alignment {freq}')
+
+
+def align_sources(histories, freq='D'):
+    ''' Aligns the time series of several sources on their common time index.
+        Timezone-aware series are compared in the wall-clock time of their timezone,
+        so callers convert the histories of a grid cell to its local timezone for
+        its daily values to line up with the dates of a station. If a frequency is
+        given each series is first averaged over its periods, which may be calendar
+        periods such as months or weeks
+
+        Parameters: histories (list), Pandas Series with sorted DatetimeIndexes
+                    freq (str), Pandas frequency to bring the series onto or None to
+                    align on exact timestamps
+        Returns: numpy array, int64 nanosecond timestamps shared by all series
+                 numpy array, float64 values of shape (sources, timestamps)
+    '''
+    aligned = []
+    for series in histories:
+        index = series.index
+        if index.tz is not None:
+            index = index.tz_localize(None)
+        series = pd.Series(float_values(series), index=index)
+        if freq is not None:
+            series = series.sort_index().resample(freq).mean().dropna()
+        aligned.append(series)
+    times = aligned[0].index.values.astype('datetime64[ns]').view('<i8')
+    for series in aligned[1:]:
+        times = np.intersect1d(times, series.index.values.astype('datetime64[ns]').view('<i8'))
+    values = np.empty((len(aligned), len(times)), dtype='<f8')
+    for row, series in enumerate(aligned):
+        series_times = series.index.values.astype('datetime64[ns]').view('<i8')
+        values[row] = series.to_numpy(dtype='<f8')[np.searchsorted(series_times, times)]
+    return times, values
+
+
+def combine_sources(histories, how, freq='D'):
+    ''' Aligns the time series of several sources and combines them into one series
+
+        Parameters: histories (list), Pandas Series with sorted DatetimeIndexes
+                    how (str), one of SOURCE_COMBINATIONS
+                    freq (str), Pandas frequency to align the series on or None
+        Returns: Pandas Series, the combined series over the common time index
+    '''
+    if how not in SOURCE_COMBINATIONS:
+        raise ValueError(f'Unsupported combination {how}')
+    if how in ('spread', 'ratio') and len(histories) != 2:
+        raise ValueError(f'Combination {how} takes exactly two sources')
+    times, values = align_sources(histories, freq)
+    if len(times) == 0:
+        raise ValueError('Sources have no time index in common')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if how == 'spread':
+            combined = values[0] - values[1]
+        elif how == 'ratio':
+            combined = values[0] / values[1]
+        elif how == 'sum':
+            combined = values.sum(axis=0)
+        elif how == 'mean':
+            combined = values.mean(axis=0)
+        elif how == 'max':
+            combined = values.max(axis=0)
+        else:
+            combined = values.min(axis=0)
+    return as_series(times, combined, None)
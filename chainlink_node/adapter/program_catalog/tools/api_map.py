@@ -0,0 +1,114 @@
+import os
+import re
+import json
+import hashlib
+
+
+# swagger document of the dClimate API, resolved next to the adapter rather than the working directory
+SWAGGER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'swagger.json')
+# compiled endpoint map, rebuilt whenever the swagger document or the wrapper table changes
+API_MAP_CACHE = os.environ.get('API_MAP_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'arbol-adapter', 'api_map.json'))
+
+# name of the client wrapper in tools/wrapper.py serving each endpoint
+CLIENT_WRAPPERS = {
+    'ceda-biomass': 'get_ceda_biomass_wrapper',
+    'cme-history': 'get_cme_station_history_wrapper',
+    'drought-monitor': 'get_drought_monitor_history_wrapper',
+    'dutch-station-history': 'get_dutch_station_history_wrapper',
+    'forecasts': 'get_forecasts_wrapper',
+    'german-station-history': 'get_german_station_history_wrapper',
+    'ghcn-history': 'get_station_history_wrapper',
+    'grid-history': 'get_gridcell_history_wrapper',
+    'irrigation_splits': 'get_irrigation_data_wrapper',
+    'metadata': 'get_metadata_wrapper',
+    'storms': 'get_tropical_storms_wrapper',
+    'transitional_yield': 'get_transitional_yield_history_wrapper',
+    'yield': 'get_yield_history_wrapper',
+    'japan-station-history': 'get_japan_station_history_wrapper'
+}
+_FORMAT_VERSION = 1
+
+
+def checksum(swagger_bytes):
+    ''' Returns: str, hex digest of a swagger document together with the wrapper table
+        and map format, so that a change to any of them invalidates a cached map
+    '''
+    m = hashlib.sha256()
+    m.update(swagger_bytes)
+    m.update(json.dumps([_FORMAT_VERSION, CLIENT_WRAPPERS], sort_keys=True).encode('utf-8'))
+    return m.hexdigest()
+
+
+def build_api_map(swagger_bytes):
+    ''' Walks the swagger document and maps each supported endpoint to its primary
+        (path) and secondary (query) parameters, their types and the name of the
+        client wrapper serving it
+
+        Parameters: swagger_bytes (bytes), contents of the swagger document
+        Returns: dict, base path and endpoint map keyed by the first path segment
+    '''
+    api = json.loads(swagger_bytes)
+
+    # parse swagger and get parameters and url endpoints
+    api_map = {'basePath': api['basePath'] + '/', 'paths': {}}
+    for path in api['paths'].keys():
+        if 'user' in path or 'valid' in path or 'biomass' in path:
+            continue
+        key = path[:path.find('/{')][1:] if '/{' in path else path[1:]
+        types = {}
+        primary = re.findall(r'(?<=\{).+?(?=\})', path) if '/{' in path else []
+        secondary = []
+        for param in api['paths'][path].get('parameters', []):
+            types[param['name']] = param['type']
+        for param in api['paths'][path].get('get', {}).get('parameters', []):
+            if param['name'] != 'Authorization':
+                secondary.append(param['name'])
+                types[param['name']] = param['type']
+        api_map['paths'][key] = {'name': path, 'primary': primary, 'secondary': secondary, 'types': types, 'function': CLIENT_WRAPPERS[key]}
+    return api_map
+
+
+def write_api_map(swagger_path=SWAGGER_PATH, cache_path=API_MAP_CACHE):
+    ''' Builds the endpoint map and writes it with the checksum of its sources to the
+        cache path, replacing any previous map atomically
+
+        Returns: dict, the endpoint map
+    '''
+    with open(swagger_path, 'rb') as swagger:
+        swagger_bytes = swagger.read()
+    api_map = build_api_map(swagger_bytes)
+    _store(cache_path, checksum(swagger_bytes), api_map)
+    return api_map
+
+
+def _store(cache_path, digest, api_map):
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as cache_file:
+        json.dump({'checksum': digest, 'api_map': api_map}, cache_file, separators=(',', ':'))
+    os.replace(tmp_path, cache_path)
+
+
+def load_api_map(swagger_path=SWAGGER_PATH, cache_path=API_MAP_CACHE):
+    ''' Loads the cached endpoint map if it was built from the current swagger
+        document, and otherwise builds it and tries to refresh the cache
+
+        Returns: dict, the endpoint map with wrapper names in place of functions
+    '''
+    with open(swagger_path, 'rb') as swagger:
+        swagger_bytes = swagger.read()
+    expected = checksum(swagger_bytes)
+    try:
+        with open(cache_path, 'r') as cache_file:
+            cached = json.load(cache_file)
+        if cached.get('checksum') == expected:
+            return cached['api_map']
+    except (OSError, ValueError):
+        pass
+    print(f'api map cache at {cache_path} missing or stale, parsing {swagger_path}', flush=True)
+    api_map = build_api_map(swagger_bytes)
+    try:
+        _store(cache_path, expected, api_map)
+    except OSError as e:
+        print(f'could not write api map cache: {e}', flush=True)
+    return api_map
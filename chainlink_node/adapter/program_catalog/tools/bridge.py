@@ -0,0 +1,151 @@
+import os
+import json
+import time
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+
+# async bridge defaults, jobs run on cooperative greenlets under the gevent workers. Off by default: a node
+# with a bridge response URL sends a responseURL on synchronous bridge tasks too, so the bridge tasks of
+# the job specs must be switched to async="true" together with this flag
+ASYNC_BRIDGE = os.environ.get('ASYNC_BRIDGE', 'false').lower() == 'true'
+ASYNC_WORKERS = int(os.environ.get('ASYNC_WORKERS', 4))
+ASYNC_MAX_PENDING = int(os.environ.get('ASYNC_MAX_PENDING', 64))
+# token of the bridge the node expects on PATCH requests to its responseURL
+BRIDGE_INCOMING_TOKEN = os.environ.get('BRIDGE_INCOMING_TOKEN', None)
+ASYNC_CALLBACK_TIMEOUT = float(os.environ.get('ASYNC_CALLBACK_TIMEOUT', 30))
+ASYNC_CALLBACK_RETRIES = int(os.environ.get('ASYNC_CALLBACK_RETRIES', 3))
+
+
+class AsyncBridge:
+    ''' Runs adapter requests in the background following the Chainlink external
+        adapter async pattern. A request carrying a responseURL is acknowledged
+        straight away with pending set, the adapter runs on a bounded pool and its
+        result is sent to the node with a PATCH to the responseURL, so the web
+        worker and the node connection are not held for the whole IPFS fetch
+
+        Requests past the pending bound are not acknowledged and run synchronously
+        instead. The pool is created on first use in each process
+    '''
+    def __init__(self, enabled=ASYNC_BRIDGE, max_workers=ASYNC_WORKERS, max_pending=ASYNC_MAX_PENDING,
+                 token=BRIDGE_INCOMING_TOKEN, callback_timeout=ASYNC_CALLBACK_TIMEOUT, callback_retries=ASYNC_CALLBACK_RETRIES):
+        ''' Parameters: enabled (bool), whether requests with a responseURL run in the background
+                        max_workers (int), number of adapter requests run at once
+                        max_pending (int), number of acknowledged requests not yet sent back
+                        token (str), bearer token sent with results to the node or None
+                        callback_timeout (float), seconds to wait on the node for each PATCH
+                        callback_retries (int), attempts at sending a result before giving up
+        '''
+        self._enabled = enabled
+        self._max_workers = max_workers
+        self._max_pending = max_pending
+        self._token = token
+        self._callback_timeout = callback_timeout
+        self._callback_retries = callback_retries
+        self._pool = None
+        self._pool_pid = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.completed = 0
+        self.failed_callbacks = 0
+        self.rejected = 0
+
+    def accepts(self, data):
+        ''' Returns: bool, whether the request asks for an async response '''
+        return self._enabled and isinstance(data, dict) and bool(data.get('responseURL'))
+
+    def submit(self, adapter_class, data, compute=None):
+        ''' Schedules an adapter request to run in the background
+
+            Parameters: adapter_class (class), adapter computing the result in its constructor
+                        data (dict), the received request body, including the responseURL
+                        compute (function), returns the adapter result, by default
+                        running the request on a new adapter instance
+            Returns: dict, the pending acknowledgement or None if too many requests
+            are pending and the request should run synchronously
+        '''
+        with self._lock:
+            if self._pending >= self._max_pending:
+                self.rejected += 1
+                return None
+            self._pending += 1
+        try:
+            self._get_pool().submit(self._run, adapter_class, data, compute)
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+            raise
+        return self.pending(adapter_class, data)
+
+    @staticmethod
+    def pending(adapter_class, data):
+        ''' Returns: dict, the acknowledgement of a request running in the background '''
+        return {
+            'jobRunID': data.get('id', adapter_class.DEFAULT_ID),
+            'pending': True,
+            'statusCode': 200,
+        }
+
+    def stats(self):
+        ''' Returns: dict, pool size and counts of pending, completed and failed requests '''
+        return {
+            'enabled': self._enabled,
+            'workers': self._max_workers,
+            'pending': self._pending,
+            'completed': self.completed,
+            'failed_callbacks': self.failed_callbacks,
+            'rejected': self.rejected,
+        }
+
+    def _run(self, adapter_class, data, compute):
+        ''' Runs an adapter request and sends its result to the node '''
+        try:
+            try:
+                result = compute() if compute is not None else adapter_class(data).result
+            except Exception as e:
+                result = {
+                    'jobRunID': data.get('id', adapter_class.DEFAULT_ID),
+                    'error': f'There was an error: {e}',
+                    'statusCode': 500,
+                }
+            if self._send(data['responseURL'], result):
+                self.completed += 1
+            else:
+                self.failed_callbacks += 1
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def _send(self, response_url, result):
+        ''' Sends a result to the node, retrying with a backoff on failure
+
+            Parameters: response_url (str), URL the node resumes the job run at
+                        result (dict), the adapter result
+            Returns: bool, whether the node accepted the result
+        '''
+        headers = {'Content-Type': 'application/json'}
+        if self._token is not None:
+            headers['Authorization'] = f'Bearer {self._token}'
+        body = json.dumps(result, default=str)
+        for attempt in range(self._callback_retries):
+            try:
+                response = requests.patch(response_url, data=body, headers=headers, timeout=self._callback_timeout)
+                if response.status_code < 400:
+                    return True
+                print(f'node rejected result for job run {result.get("jobRunID")}: {response.status_code}', flush=True)
+            except requests.RequestException as e:
+                print(f'could not send result for job run {result.get("jobRunID")}: {e}', flush=True)
+            if attempt + 1 < self._callback_retries:
+                time.sleep(2 ** attempt)
+        return False
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ThreadPoolExecutor(max_workers=self._max_workers)
+                self._pool_pid = os.getpid()
+            return self._pool
+
+
+BRIDGE = AsyncBridge()
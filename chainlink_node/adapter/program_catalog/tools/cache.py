@@ -0,0 +1,581 @@
+import os
+import json
+import time
+import pickle
+import hashlib
+import inspect
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+from dweather.dweather_client import client
+
+
+# on-disk history cache defaults, a size of 0 disables the cache
+HISTORY_CACHE_DIR = os.environ.get('HISTORY_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'arbol-adapter', 'histories'))
+HISTORY_CACHE_MAX_BYTES = int(os.environ.get('HISTORY_CACHE_MAX_BYTES', 2 * 1024**3))
+
+_RECORD_DTYPE = np.dtype([('time', '<i8'), ('value', '<f8')])
+# client arguments that change how a history is fetched but not the history itself
+_TRANSPORT_ARGS = ('ipfs_timeout',)
+
+
+# dataset heads cache defaults, heads are refreshed in the background shortly before they expire
+DATASET_HEADS_TTL = float(os.environ.get('DATASET_HEADS_TTL', 300))
+DATASET_HEADS_REFRESH = os.environ.get('DATASET_HEADS_REFRESH', 'true').lower() == 'true'
+# seconds the previous heads keep being served after a failed refresh before it is retried
+DATASET_HEADS_RETRY = float(os.environ.get('DATASET_HEADS_RETRY', 30))
+DATASET_METADATA_MAX_SIZE = int(os.environ.get('DATASET_METADATA_MAX_SIZE', 256))
+
+# number of /api responses kept per worker, 0 disables the response cache
+API_RESPONSE_CACHE_SIZE = int(os.environ.get('API_RESPONSE_CACHE_SIZE', 1024))
+
+
+class LRUCache:
+    ''' Thread-safe in-memory least recently used cache with hit and miss counters '''
+    def __init__(self, max_size, on_evict=None):
+        ''' On initialization the cache sets its capacity and eviction callback
+
+            Parameters: max_size (int), maximum number of entries
+                        on_evict (function), called with the key and value of each evicted entry
+        '''
+        self._max_size = max_size
+        self._on_evict = on_evict
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        ''' Gets the value for a key and marks it as recently used
+
+            Parameters: key (hashable), key to look up
+                        default (object), value to return on a miss
+            Returns: object, the cached value or default on a miss
+        '''
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        ''' Sets the value for a key and evicts least recently used entries past capacity
+
+            Parameters: key (hashable), key to set
+                        value (object), value to cache
+        '''
+        evicted = []
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                evicted.append(self._entries.popitem(last=False))
+        if self._on_evict is not None:
+            for evicted_key, evicted_value in evicted:
+                self._on_evict(evicted_key, evicted_value)
+
+    def clear(self):
+        ''' Removes all entries, passing each to the eviction callback '''
+        with self._lock:
+            evicted = list(self._entries.items())
+            self._entries.clear()
+        if self._on_evict is not None:
+            for evicted_key, evicted_value in evicted:
+                self._on_evict(evicted_key, evicted_value)
+
+    def stats(self):
+        ''' Returns: dict, hit and miss counts and current size '''
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+
+class _Flight:
+    ''' A call in progress that duplicate callers wait on '''
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    ''' Coalesces concurrent calls with the same key onto one in-flight call, so
+        that requests asking for the same data at the same moment within a worker
+        share one download and its parsed result. Nothing is kept once the call
+        returns, caching is left to the caller
+    '''
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key, function):
+        ''' Calls a function, or waits on the call already in flight for the key
+
+            Parameters: key (hashable), identifies the call
+                        function (function), takes no arguments and returns the result
+            Returns: object, the result of the call, shared by all callers of the key
+        '''
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = function()
+            return flight.result
+        except BaseException as e:
+            # includes gevent.Timeout and GreenletExit, so followers never see a result of None
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def in_flight(self, key):
+        ''' Returns: bool, whether a call for the key is in flight '''
+        return key in self._flights
+
+    def stats(self):
+        ''' Returns: dict, calls made, calls coalesced onto them and calls in flight '''
+        return {'calls': self.calls, 'coalesced': self.coalesced, 'in_flight': len(self._flights)}
+
+
+FETCHES = SingleFlight()
+
+
+def coalesced_fetch(key_parts, fetch):
+    ''' Fetches data from IPFS, sharing the download with any identical fetch in flight
+
+        Parameters: key_parts (tuple), JSON-serializable parts identifying the fetch
+                    fetch (function), downloads and parses the data
+        Returns: object, the fetched data, dicts are shallow copied so that each caller
+        can replace their entries without affecting the others
+    '''
+    result = FETCHES.do(HistoryCache.key(*key_parts), fetch)
+    return dict(result) if isinstance(result, dict) else result
+
+
+class DatasetHeadCache:
+    ''' Process-wide cache of dClimate dataset heads and metadata. Heads are
+        held for a configurable TTL and refreshed by a background thread
+        (a greenlet under the gevent workers) so requests resolve a dataset to
+        its CID without a network round trip. Metadata is immutable per CID and
+        is cached by CID
+    '''
+    def __init__(self, ttl=DATASET_HEADS_TTL, refresh=DATASET_HEADS_REFRESH, metadata_size=DATASET_METADATA_MAX_SIZE, retry=DATASET_HEADS_RETRY):
+        ''' On initialization the cache sets how long heads are valid and
+            whether to refresh them in the background
+
+            Parameters: ttl (float), seconds for which fetched heads are valid
+                        refresh (bool), whether to refresh heads in the background
+                        metadata_size (int), maximum number of metadata documents to keep
+                        retry (float), seconds to keep serving the previous heads after a failed refresh
+        '''
+        self._ttl = ttl
+        self._refresh = refresh
+        self._retry = retry
+        self._heads = None
+        self._fetched_at = 0
+        self._lock = threading.Lock()
+        self._refresher_pid = None
+        self._metadata = LRUCache(metadata_size)
+        self.hits = 0
+        self.misses = 0
+
+    def heads(self):
+        ''' Gets the mapping of dataset names to head CIDs, fetching it if expired
+
+            Returns: dict, mapping of dataset names to head hashes
+        '''
+        self._start_refresher()
+        heads = self._heads
+        if heads is not None and time.monotonic() - self._fetched_at < self._ttl:
+            self.hits += 1
+            return heads
+        self.misses += 1
+        with self._lock:
+            if self._heads is None or time.monotonic() - self._fetched_at >= self._ttl:
+                self._fetch_heads()
+            return self._heads
+
+    def get_head(self, dataset_name):
+        ''' Resolves a dataset name to the CID of its current head on IPFS
+
+            Parameters: dataset_name (str), the name of the dataset on IPFS
+            Returns: str, the dataset head hash or None if the dataset has no head
+        '''
+        return self.heads().get(dataset_name, None)
+
+    def get_metadata(self, dataset_name):
+        ''' Gets the metadata for the current head of a dataset
+
+            Parameters: dataset_name (str), the name of the dataset on IPFS
+            Returns: str, the dataset head hash
+                     dict, the dataset metadata
+        '''
+        head = self.heads()[dataset_name]
+        metadata = self._metadata.get(head)
+        if metadata is None:
+            metadata = FETCHES.do(('metadata', head), lambda: client.get_metadata(head))
+            self._metadata.put(head, metadata)
+        return head, metadata
+
+    def stats(self):
+        ''' Returns: dict, hit and miss counts for heads and metadata '''
+        return {
+            'heads': {'hits': self.hits, 'misses': self.misses, 'age': time.monotonic() - self._fetched_at if self._heads is not None else None},
+            'metadata': self._metadata.stats(),
+        }
+
+    def _fetch_heads(self):
+        ''' Fetches heads from IPFS, keeping the previous heads if the fetch fails. After
+            a failure the previous heads are served for the retry interval, so that during
+            an outage requests do not each wait on a fetch in turn
+        '''
+        try:
+            heads = client.get_heads()
+        except Exception as e:
+            if self._heads is None:
+                raise
+            print(f'could not refresh dataset heads, retrying in {self._retry} seconds: {e}', flush=True)
+            self._fetched_at = time.monotonic() - self._ttl + min(self._retry, self._ttl)
+            return
+        self._heads = heads
+        self._fetched_at = time.monotonic()
+
+    def _start_refresher(self):
+        ''' Starts the background refresh thread once per process '''
+        if not self._refresh or self._refresher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._refresher_pid == os.getpid():
+                return
+            self._refresher_pid = os.getpid()
+            threading.Thread(target=self._refresh_loop, daemon=True).start()
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(max(self._ttl * 0.8, 1))
+            with self._lock:
+                self._fetch_heads()
+
+
+DATASET_HEADS = DatasetHeadCache()
+
+
+def get_head(dataset_name):
+    ''' Resolves a dataset name to the CID of its current head on IPFS
+
+        Parameters: dataset_name (str), the name of the dataset on IPFS
+        Returns: str, the dataset head hash or None if the dataset has no head
+    '''
+    return DATASET_HEADS.get_head(dataset_name)
+
+
+class ResponseCache:
+    ''' Per-worker cache of /api responses. Entries are keyed by the parsed request
+        URL, the requested operations and their parameters, and the head CID the
+        dataset resolved to, so a new head makes every older entry unreachable and
+        they age out of the LRU without explicit invalidation
+    '''
+    def __init__(self, max_size=API_RESPONSE_CACHE_SIZE):
+        ''' Parameters: max_size (int), number of responses kept, 0 to disable caching '''
+        self._max_size = max_size
+        self._entries = LRUCache(max_size)
+
+    def key(self, args, ops, params, mode='single'):
+        ''' Builds the key of a request
+
+            Parameters: args (dict), endpoint arguments returned by the router, including '_key',
+                        or a list of them for a multi-source request
+                        ops (list), names of the requested operations or None
+                        params (list), parameters of the requested operations
+                        mode (object), JSON-serializable description of how results are
+                        combined and returned, for example 'single' or 'multi'
+            Returns: tuple, key of the request or None if it can not be cached, because
+            caching is disabled or an endpoint does not read from a dataset with a head
+        '''
+        if self._max_size <= 0:
+            return None
+        sources = args if isinstance(args, list) else [args]
+        heads = []
+        for source in sources:
+            head = DATASET_HEADS.get_head(source['dataset']) if 'dataset' in source else None
+            if head is None:
+                return None
+            heads.append(head)
+        normalized = json.dumps(args, sort_keys=True, default=str)
+        return (normalized, json.dumps(ops, default=str), json.dumps(params, default=str), json.dumps(mode), tuple(heads))
+
+    def get(self, key):
+        ''' Returns: object, the cached response for a key or None on a miss '''
+        if key is None:
+            return None
+        return self._entries.get(key)
+
+    def put(self, key, response):
+        ''' Caches the response for a key, unless the key is None '''
+        if key is not None:
+            self._entries.put(key, response)
+
+    def stats(self):
+        ''' Returns: dict, hit and miss counts and current size '''
+        return self._entries.stats()
+
+
+RESPONSE_CACHE = ResponseCache()
+
+
+class HistoryCache:
+    ''' Content-addressed on-disk cache for weather data histories. Dataset heads
+        on IPFS are immutable, so any history keyed by the head it was read from
+        never goes stale and only needs evicting when the cache grows too large
+
+        Each entry is a structured .npy file of (int64 nanosecond timestamp, float64 value)
+        records that can be memory mapped and sliced without reading the whole history,
+        plus a pickled sidecar with the series name, timezone, unit and any extra fields
+        returned by the client alongside the data, kept as returned so that a cached
+        history is indistinguishable from a fetched one
+    '''
+    def __init__(self, directory=HISTORY_CACHE_DIR, max_bytes=HISTORY_CACHE_MAX_BYTES):
+        ''' On initialization the cache sets where to store entries and how large
+            the cache directory is allowed to grow
+
+            Parameters: directory (str), path of the cache directory
+                        max_bytes (int), size cap for all entries, 0 to disable caching
+        '''
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self._max_bytes > 0
+
+    @staticmethod
+    def key(*parts):
+        ''' Builds a cache key from the given key parts
+
+            Parameters: parts (tuple), JSON-serializable parts identifying a history,
+            the first of which should be the dataset head hash
+            Returns: str, hex digest for the given parts
+        '''
+        serialized = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+    def load(self, key_parts, fetch, window=None):
+        ''' Gets a history from the cache or fetches and stores it on a miss. Identical
+            fetches in flight in the worker share one download
+
+            Parameters: key_parts (tuple), parts identifying the history, starting with
+                        the dataset head hash (if the head is None the cache is bypassed)
+                        fetch (function), returns the history as a dict with a Pandas
+                        Series with a sorted DatetimeIndex under key "data"
+                        window (tuple), optional (start, end) dates to restrict the
+                        returned history to, naive dates are read as UTC for
+                        timezone-aware histories
+            Returns: dict, the history with its Series under key "data"
+        '''
+        key = self.key(*key_parts)
+        if not self.enabled or key_parts[0] is None:
+            return slice_history(dict(FETCHES.do(key, fetch)), window)
+        result = self.get(key, window)
+        if result is None:
+            # concurrent misses share one download, which is written to the cache once
+            result = slice_history(dict(FETCHES.do(key, lambda: self._fetch(key, fetch))), window)
+        return result
+
+    def _fetch(self, key, fetch):
+        result = fetch()
+        self.put(key, result)
+        return result
+
+    def get(self, key, window=None):
+        ''' Reads a cached history and marks it as recently used. If a window
+            is given only the pages of the memory mapped entry covering it are read
+
+            Parameters: key (str), cache key of the history
+                        window (tuple), optional (start, end) dates to restrict the history to
+            Returns: dict, the cached history or None on a miss
+        '''
+        data_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path, 'rb') as meta_file:
+                meta = pickle.load(meta_file)
+            records = np.load(data_path, mmap_mode='r')
+            os.utime(data_path)
+        except (FileNotFoundError, ValueError, OSError, pickle.UnpicklingError, EOFError):
+            return None
+        if window is not None:
+            first, last = window_positions(records['time'], window)
+            records = records[first:last]
+        times = np.array(records['time'])
+        values = np.array(records['value'])
+        index = pd.DatetimeIndex(times.view('datetime64[ns]'), name=meta['index_name'])
+        if meta['tz'] is not None:
+            index = index.tz_localize('UTC').tz_convert(meta['tz'])
+        if meta['unit'] is not None:
+            # the unit is unpickled as the client's own unit, rebuilding its per-value quantities
+            values = list(values * meta['unit'])
+        else:
+            values = values.astype(meta['dtype'])
+        result = dict(meta['extras'])
+        result['data'] = pd.Series(values, index=index, name=meta['name'])
+        return result
+
+    def put(self, key, result):
+        ''' Writes a history to the cache, skipping any series that can not be
+            represented as float values, and evicts least recently used entries
+            if the cache has grown past its size cap
+
+            Parameters: key (str), cache key of the history
+                        result (dict), the history with its Series under key "data"
+        '''
+        series = result['data']
+        if not isinstance(series, pd.Series) or not isinstance(series.index, pd.DatetimeIndex) or series.empty:
+            # empty histories are left to each caller to reject, as they do on a fetch
+            return
+        unit = None
+        values = series.values
+        if values.dtype == object and len(values) > 0 and hasattr(values[0], 'unit'):
+            unit = values[0].unit
+            try:
+                values = np.array([value.to_value(values[0].unit) for value in values], dtype='<f8')
+            except (AttributeError, TypeError):
+                return
+        elif values.dtype.kind not in 'iuf':
+            return
+        extras = {k: v for k, v in result.items() if k != 'data'}
+        index = series.index
+        tz = index.tz
+        if tz is not None:
+            index = index.tz_convert('UTC').tz_localize(None)
+        records = np.empty(len(series), dtype=_RECORD_DTYPE)
+        records['time'] = index.values.astype('datetime64[ns]').view('<i8')
+        records['value'] = values
+        meta = {'name': series.name, 'index_name': series.index.name, 'tz': tz, 'unit': unit, 'dtype': values.dtype.str, 'extras': extras}
+        try:
+            meta = pickle.dumps(meta)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            # a history that can not be restored exactly is not cached
+            return
+
+        os.makedirs(self._directory, exist_ok=True)
+        data_path, meta_path = self._paths(key)
+        suffix = f'.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(meta_path + suffix, 'wb') as meta_file:
+            meta_file.write(meta)
+        with open(data_path + suffix, 'wb') as data_file:
+            np.save(data_file, records)
+        os.replace(meta_path + suffix, meta_path)
+        os.replace(data_path + suffix, data_path)
+        self._evict()
+
+    def _paths(self, key):
+        return os.path.join(self._directory, key + '.npy'), os.path.join(self._directory, key + '.pkl')
+
+    def _evict(self):
+        ''' Removes least recently used entries until the cache fits its size cap '''
+        with self._lock:
+            entries = []
+            total = 0
+            for entry in os.scandir(self._directory):
+                if not entry.name.endswith('.npy'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self._max_bytes:
+                    break
+                for stale in (path, path[:-len('.npy')] + '.pkl'):
+                    try:
+                        os.remove(stale)
+                    except FileNotFoundError:
+                        pass
+                total -= size
+
+
+def history_key_parts(head, method, *args, **kwargs):
+    ''' Builds the key parts of a history fetched with a client method. Arguments are
+        bound to the method signature with its defaults filled in, so every caller
+        fetching the same history shares one cache entry however it passes them
+
+        Parameters: head (str), head hash of the dataset the history is read from
+                    method (str), name of the client method fetching the history
+                    args (tuple), positional arguments of the client call
+                    kwargs (dict), keyword arguments of the client call
+        Returns: tuple, key parts for HistoryCache.load
+    '''
+    try:
+        bound = inspect.signature(getattr(client, method)).bind(*args, **kwargs)
+        bound.apply_defaults()
+        arguments = dict(bound.arguments)
+        for name, parameter in bound.signature.parameters.items():
+            if parameter.kind == parameter.VAR_KEYWORD:
+                arguments.update(arguments.pop(name, {}))
+    except (AttributeError, TypeError, ValueError):
+        arguments = {**{str(position): arg for position, arg in enumerate(args)}, **kwargs}
+    return (head, method, {k: v for k, v in arguments.items() if k not in _TRANSPORT_ARGS})
+
+
+def window_positions(times, window):
+    ''' Finds the positions bounding a closed date window in sorted timestamps
+
+        Parameters: times (numpy array), sorted int64 nanosecond UTC (or naive) timestamps
+                    window (tuple), (start, end) dates, either may be None for an open bound
+        Returns: int, position of the first timestamp in the window
+                 int, position after the last timestamp in the window
+    '''
+    bounds = []
+    for bound in window:
+        if bound is None:
+            bounds.append(None)
+            continue
+        bound = pd.Timestamp(bound)
+        if bound.tzinfo is not None:
+            bound = bound.tz_convert('UTC').tz_localize(None)
+        bounds.append(np.datetime64(bound.to_datetime64(), 'ns').astype('<i8'))
+    first = 0 if bounds[0] is None else int(np.searchsorted(times, bounds[0], side='left'))
+    last = len(times) if bounds[1] is None else int(np.searchsorted(times, bounds[1], side='right'))
+    return first, last
+
+
+def slice_history(result, window):
+    ''' Restricts a history to a closed date window
+
+        Parameters: result (dict), the history with its Series under key "data"
+                    window (tuple), (start, end) dates or None for the full history
+        Returns: dict, the history with its Series restricted to the window
+    '''
+    if window is None:
+        return result
+    series = result['data']
+    index = series.index
+    if index.tz is not None:
+        index = index.tz_convert('UTC').tz_localize(None)
+    first, last = window_positions(index.values.astype('datetime64[ns]').view('<i8'), window)
+    return {**result, 'data': series.iloc[first:last]}
+
+
+HISTORY_CACHE = HistoryCache()
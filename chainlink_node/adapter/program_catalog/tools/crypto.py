@@ -3,6 +3,8 @@ import json
 import base64
 import hashlib
 import hmac
+import ast
+from concurrent.futures import ThreadPoolExecutor
 
 from coincurve import PrivateKey, PublicKey
 from coincurve.utils import get_valid_secret
@@ -10,9 +12,21 @@ from coincurve.utils import get_valid_secret
 from Crypto.Cipher import AES
 from Crypto.Util.Padding import pad, unpad
 
+from program_catalog.tools.cache import LRUCache
+from program_catalog.tools.executor import CPU_EXECUTOR
+
 # this is a dict for some reason when loading from SecretsManager
 PRIVATE_KEY = bytes.fromhex(json.loads(os.environ.get("NODE_PRIVATE_KEY"))["NODE_PRIVATE_KEY"])
 
+# decrypted contract terms cache defaults, evicted terms are spilled encrypted to disk if a directory is set
+TERMS_CACHE_SIZE = int(os.environ.get("TERMS_CACHE_SIZE", 256))
+TERMS_CACHE_SPILL_DIR = os.environ.get("TERMS_CACHE_SPILL_DIR", "")
+TERMS_CACHE_SPILL_MAX_FILES = int(os.environ.get("TERMS_CACHE_SPILL_MAX_FILES", 4096))
+# number of ephemeral public keys for which derived shared and MAC keys are kept
+KEY_DERIVATION_CACHE_SIZE = int(os.environ.get("KEY_DERIVATION_CACHE_SIZE", 256))
+# number of public keys encrypted for concurrently in a bulk re-encryption
+REENCRYPTION_WORKERS = int(os.environ.get("REENCRYPTION_WORKERS", 1))
+
 
 def get_shared_key(public_key, private_key):
     ''' Takes a public key and a private key, presumably from 2 peers 
@@ -98,19 +112,13 @@ def decompress_public_key(public_key: bytes):
         Returns: int, the length of the initially supplied public key after its compression
         state has been determined
     '''
-    print('decompress_public_key', flush=True)
-    print(f'public_key {public_key}', flush=True)
     if (public_key[0] == 2 or public_key[0] == 3) and len(public_key) >= 33:
-        print(f'public_key {public_key[:33]}', flush=True)
         return PublicKey(public_key[:33]).format(compressed=False), 33
     elif public_key[0] == 4 and len(public_key) == 65:
-        print(f'public_key {public_key}', flush=True)
         return public_key, 65
     elif len(public_key) == 64:
-        print(f'public_key {bytes.fromhex("04") + public_key}', flush=True)
         return bytes.fromhex('04') + public_key, 64
     else:
-        print('failed', flush=True)
         return f'cannot decompress invalid public key', 0
 
 
@@ -149,8 +157,6 @@ def parse_key_cipher(cipher_bytes: bytes):
     '''
     print('parse_key_cipher', flush=True)
     public_key, initial_length = decompress_public_key(cipher_bytes[16:81])
-    print(f'public_key {public_key}', flush=True)
-    print(f'initial_length {initial_length}', flush=True)
     if type(public_key) is not bytes:
         return {'error': public_key}
     else:
@@ -162,6 +168,51 @@ def parse_key_cipher(cipher_bytes: bytes):
         }
 
 
+class KeyContext:
+    ''' Holds the node's parsed private key for the lifetime of a worker so that it is
+        not rebuilt from raw bytes on every request, along with a small LRU of the
+        shared and MAC keys derived for each ephemeral public key seen in a node key,
+        so that node keys received repeatedly skip the ECDH multiply
+
+        Use key_context() to get the context of the current worker
+    '''
+    def __init__(self, private_key=PRIVATE_KEY, max_size=KEY_DERIVATION_CACHE_SIZE):
+        ''' Parameters: private_key (bytes), bytestring of the node private key
+                        max_size (int), number of ephemeral public keys for which derived keys are kept
+        '''
+        self.private_key = PrivateKey(private_key)
+        self._derived = LRUCache(max_size)
+
+    def shared_key(self, ephemeral_public_key: bytes):
+        ''' Derives the shared key and MAC key of the node and an ephemeral public key
+
+            Parameters: ephemeral_public_key (bytes), bytestring of decompressed ephemeral public key
+            Returns: bytes, the derived shared key
+                     bytes, the derived MAC key
+        '''
+        derived = self._derived.get(ephemeral_public_key)
+        if derived is None:
+            derived = get_shared_key(PublicKey(ephemeral_public_key), self.private_key)
+            self._derived.put(ephemeral_public_key, derived)
+        return derived
+
+    def stats(self):
+        return self._derived.stats()
+
+
+_KEY_CONTEXT = None
+
+
+def key_context():
+    ''' Returns: KeyContext, the key context of the current worker, created on first use
+        so that each forked worker parses the private key in its own process
+    '''
+    global _KEY_CONTEXT
+    if _KEY_CONTEXT is None or _KEY_CONTEXT[0] != os.getpid():
+        _KEY_CONTEXT = (os.getpid(), KeyContext())
+    return _KEY_CONTEXT[1]
+
+
 def encrypt_access_key(access_key: bytes, public_key: bytes):
     ''' Encrypts the contract access key for the supplied public key
 
@@ -190,7 +241,6 @@ def encrypt_access_key(access_key: bytes, public_key: bytes):
     ephemeral_public_key = ephemeral_private_key.public_key.format(compressed=False)
 
     decompressed, _ = decompress_public_key(public_key)
-    print(f'decompressed {decompressed}', flush=True)
     if type(decompressed) is not bytes:
         return {'error': decompressed}
     public_key = PublicKey(decompressed)
@@ -212,7 +262,7 @@ def encrypt_access_key(access_key: bytes, public_key: bytes):
     return iv + compress_public_key(ephemeral_public_key) + ciphertext + bytes.fromhex(mac.hexdigest())
 
 
-def decrypt_access_key(node_key: bytes, private_key=PRIVATE_KEY):
+def decrypt_access_key(node_key: bytes, context=None):
     ''' Retrieves the contract access key from the node key cipher
 
         The node key is an encrypted payload containing the contract
@@ -235,7 +285,8 @@ def decrypt_access_key(node_key: bytes, private_key=PRIVATE_KEY):
 
         Parameters: node_key (bytes), bytestring of contract access key encrypted
         for the Chainlink node
-        Parameters: private_key (bytes), bytestring of private key for decryption of node_key
+        Parameters: context (KeyContext), key context holding the node private key,
+        defaults to the context of the current worker
         Returns: bytes, bytestring of access key for decrypting contract URI
     '''
     print('decrypt_access_key', flush=True)
@@ -243,14 +294,9 @@ def decrypt_access_key(node_key: bytes, private_key=PRIVATE_KEY):
     if 'error' in cipher_args:
         return cipher_args['error']
 
-    print(f'cipher_args {cipher_args}', flush=True)
-    print(f'ephemPublicKey type {type(cipher_args["ephemPublicKey"])}', flush=True)
-    print(f'private_key type {type(private_key)}', flush=True)
-
-    ephemeral_public_key = PublicKey(cipher_args['ephemPublicKey'])
-    private_key = PrivateKey(private_key)
-
-    shared_key, mac_key = get_shared_key(ephemeral_public_key, private_key)
+    if context is None:
+        context = key_context()
+    shared_key, mac_key = context.shared_key(cipher_args['ephemPublicKey'])
 
     data_to_mac = cipher_args['iv'] + cipher_args['ephemPublicKey'] + cipher_args['ciphertext']
     if not verify_mac(cipher_args['mac'], mac_key, data_to_mac):
@@ -261,17 +307,19 @@ def decrypt_access_key(node_key: bytes, private_key=PRIVATE_KEY):
     return bytes.fromhex(access_key.decode('utf-8'))
 
 
-def reencrypt(node_key: bytes, public_key: bytes):
+def reencrypt(node_key: bytes, public_key: bytes, context=None):
     ''' Decrypts the encrypted node key and re-encrypts it 
         with the given public key and returns the encrypted string. 
 
         Parameters: node_key (str), base 64 encoded string of access key encrypted for the Chainlink node
         Parameters: public_key (str), base 64 encoded string of public key to be used for encryption
+        Parameters: context (KeyContext), key context holding the node private key,
+        defaults to the context of the current worker
         Returns: bytes, bytestring of re-encrypted contract access key
     '''
     print('reencrypt', flush=True)
     node_key_bytes = base64.b64decode(node_key)
-    access_key = decrypt_access_key(node_key_bytes)
+    access_key = decrypt_access_key(node_key_bytes, context)
     if type(access_key) is not bytes:
         return {'error': access_key}
     public_key_bytes = base64.b64decode(public_key)
@@ -279,6 +327,108 @@ def reencrypt(node_key: bytes, public_key: bytes):
     return encryption
 
 
+class TermsCache:
+    ''' Bounded in-memory cache of decrypted contract terms keyed by a hash of the
+        encrypted node key and URI, so that retried and repeatedly settled evaluations
+        skip the ECDH, HMAC and AES work entirely
+
+        Terms are held as serialized bytearrays that are overwritten with zeros when
+        evicted (copies handed out to callers are ordinary Python objects and are
+        not covered). If a spill directory is configured, evicted terms are first
+        written there encrypted with AES-GCM under a key derived from the node's
+        private key, so that only this node can read them back
+    '''
+    def __init__(self, max_size=TERMS_CACHE_SIZE, spill_dir=TERMS_CACHE_SPILL_DIR, spill_max_files=TERMS_CACHE_SPILL_MAX_FILES, private_key=PRIVATE_KEY):
+        ''' On initialization the cache sets its capacity and spill settings
+
+            Parameters: max_size (int), maximum number of terms held in memory
+                        spill_dir (str), directory for encrypted evicted terms or "" to disable
+                        spill_max_files (int), maximum number of spilled terms kept
+                        private_key (bytes), node private key to derive the spill key from
+        '''
+        self._entries = LRUCache(max_size, on_evict=self._evict)
+        self._spill_dir = spill_dir
+        self._spill_max_files = spill_max_files
+        self._spill_key = hmac.new(private_key, msg=b'terms-cache-spill', digestmod=hashlib.sha256).digest()
+
+    @staticmethod
+    def key(node_key: str, uri: str):
+        ''' Returns: str, hex digest identifying an encrypted node key and URI pair '''
+        return hashlib.sha256(node_key.encode('utf-8') + b'\x00' + uri.encode('utf-8')).hexdigest()
+
+    def get(self, node_key: str, uri: str):
+        ''' Gets the decrypted terms for an encrypted node key and URI pair
+
+            Parameters: node_key (str), base 64 encoded string of access key encrypted for the Chainlink node
+                        uri (str), base 64 encoded NFT URI
+            Returns: dict, a fresh copy of the decrypted terms or None on a miss
+        '''
+        key = self.key(node_key, uri)
+        plaintext = self._entries.get(key)
+        if plaintext is None:
+            plaintext = self._read_spill(key)
+            if plaintext is None:
+                return None
+            self._entries.put(key, plaintext)
+        try:
+            return json.loads(bytes(plaintext))
+        except ValueError:
+            # zeroized by a concurrent eviction
+            return None
+
+    def put(self, node_key: str, uri: str, terms: dict):
+        ''' Caches the decrypted terms for an encrypted node key and URI pair
+
+            Parameters: node_key (str), base 64 encoded string of access key encrypted for the Chainlink node
+                        uri (str), base 64 encoded NFT URI
+                        terms (dict), the decrypted contract terms
+        '''
+        self._entries.put(self.key(node_key, uri), bytearray(json.dumps(terms).encode('utf-8')))
+
+    def stats(self):
+        return self._entries.stats()
+
+    def _evict(self, key, plaintext):
+        ''' Spills evicted terms to disk if configured and zeroizes them in memory '''
+        try:
+            if self._spill_dir:
+                self._write_spill(key, plaintext)
+        finally:
+            plaintext[:] = bytes(len(plaintext))
+
+    def _write_spill(self, key, plaintext):
+        os.makedirs(self._spill_dir, exist_ok=True)
+        nonce = os.urandom(12)
+        aes_cipher = AES.new(self._spill_key, AES.MODE_GCM, nonce=nonce)
+        aes_cipher.update(key.encode('utf-8'))
+        ciphertext, tag = aes_cipher.encrypt_and_digest(bytes(plaintext))
+        path = os.path.join(self._spill_dir, key)
+        with open(path + '.tmp', 'wb') as spill_file:
+            spill_file.write(nonce + tag + ciphertext)
+        os.replace(path + '.tmp', path)
+        spilled = sorted((entry.stat().st_mtime, entry.path) for entry in os.scandir(self._spill_dir) if not entry.name.endswith('.tmp'))
+        for _, stale in spilled[:max(len(spilled) - self._spill_max_files, 0)]:
+            try:
+                os.remove(stale)
+            except FileNotFoundError:
+                pass
+
+    def _read_spill(self, key):
+        if not self._spill_dir:
+            return None
+        try:
+            with open(os.path.join(self._spill_dir, key), 'rb') as spill_file:
+                spilled = spill_file.read()
+            aes_cipher = AES.new(self._spill_key, AES.MODE_GCM, nonce=spilled[:12])
+            aes_cipher.update(key.encode('utf-8'))
+            return bytearray(aes_cipher.decrypt_and_verify(spilled[28:], spilled[12:28]))
+        except (FileNotFoundError, ValueError):
+            return None
+
+
+TERMS_CACHE = TermsCache()
+
+
 def decrypt(node_key: str, uri: str):
     ''' Accepts 2 encrypted objects, the first of which should be an AES-GCM 
         encryption key encrypted with ECIES (using AES-CBC) with the public key of the 
@@ -296,8 +446,22 @@ def decrypt(node_key: str, uri: str):
         Returns: dict, the unencrypted contents of the NFT URI
     '''
     print('decrypt', flush=True)
+    terms = TERMS_CACHE.get(node_key, uri)
+    if terms is not None:
+        return terms
+    terms = CPU_EXECUTOR.run('crypto', _decrypt_terms, node_key, uri)
+    if 'error' not in terms:
+        TERMS_CACHE.put(node_key, uri, terms)
+    return terms
+
+
+def _decrypt_terms(node_key: str, uri: str):
+    ''' Decrypts the node key and then the contract terms, see decrypt
+
+        Returns: dict, the unencrypted contents of the NFT URI
+    '''
     node_key_bytes = base64.b64decode(node_key)
-    access_key = decrypt_access_key(node_key_bytes)
+    access_key = decrypt_access_key(node_key_bytes, key_context())
     if type(access_key) is not bytes:
         return {'error': access_key}
 
@@ -307,8 +471,7 @@ def decrypt(node_key: str, uri: str):
     mac = uri_bytes[-16:]
 
     aes_cipher = AES.new(access_key, AES.MODE_GCM, nonce=iv)
-    uri = aes_cipher.decrypt_and_verify(ciphertext, mac).decode('utf-8')
-    return json.loads(uri)
+    return json.loads(aes_cipher.decrypt_and_verify(ciphertext, mac).decode('utf-8'))
 
 
 class Reencryption:
@@ -343,6 +506,82 @@ class Reencryption:
             Parameters: params (dict), dictionary of required parameters
             Returns: string, the re-encrypted access key
         '''
-        reencrypted_bytes = reencrypt(params["node_key"], params["public_key"])
+        reencrypted_bytes = CPU_EXECUTOR.run('crypto', reencrypt, params["node_key"], params["public_key"])
+        if type(reencrypted_bytes) is not bytes:
+            raise ValueError(reencrypted_bytes['error'])
         reencrypted_string = base64.b64encode(reencrypted_bytes)
-        return reencrypted_string.decode()
\ No newline at end of file
+        return reencrypted_string.decode()
+
+
+class BulkReencryption:
+    ''' Wrapper Program class for re-encrypting an Arbol NFT contract access key for
+        many viewers in one request. Decrypts the (encrypted) node key with the private
+        key once and then encrypts the access key for each supplied public key
+    '''
+    _PROGRAM_PARAMETERS = ['node_key', "public_keys"]
+
+
+    @classmethod
+    def validate_request(cls, params):
+        ''' Asserts that the Chainlink request includes a node key and a non-empty
+            list of public keys
+
+            Parameters: params (dict), parameters to be checked against the
+            requirements
+            Returns: bool, whether the request format is valid
+                     str, error message in the event that the request is not valid
+        '''
+        result = True
+        result_msg = ""
+        for param in cls._PROGRAM_PARAMETERS:
+            if params.get(param, None) is None:
+                result_msg += f'missing {param} parameter\n'
+                result = False
+        if result and len(cls.public_keys(params)) == 0:
+            result_msg += 'no public keys supplied\n'
+            result = False
+        return result, result_msg
+
+    @staticmethod
+    def public_keys(params):
+        ''' Returns: list, the public keys of a request, parsed if given as a string '''
+        public_keys = params['public_keys']
+        if type(public_keys) == str:
+            public_keys = ast.literal_eval(public_keys)
+        return list(public_keys)
+
+    @classmethod
+    def serve_request(cls, params, max_workers=REENCRYPTION_WORKERS):
+        ''' Encrypts the contract access key for each of the given public keys
+
+            Parameters: params (dict), dictionary of required parameters
+                        max_workers (int), number of public keys encrypted for concurrently
+            Returns: list, a {'result': re-encrypted access key} or {'error': message}
+            for each public key in order
+        '''
+        access_key = CPU_EXECUTOR.run('crypto', decrypt_access_key, base64.b64decode(params["node_key"]))
+        if type(access_key) is not bytes:
+            raise ValueError(access_key)
+        public_keys = cls.public_keys(params)
+        print(f'reencrypting for {len(public_keys)} public keys', flush=True)
+        encrypt = lambda public_key: CPU_EXECUTOR.run('crypto', cls._encrypt, access_key, public_key)
+        if max_workers <= 1 or len(public_keys) == 1:
+            return [encrypt(public_key) for public_key in public_keys]
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(public_keys))) as executor:
+            return list(executor.map(encrypt, public_keys))
+
+    @staticmethod
+    def _encrypt(access_key, public_key):
+        ''' Encrypts the access key for a single public key, capturing any error as its result
+
+            Parameters: access_key (bytes), bytestring of decrypted contract access key
+                        public_key (str), base 64 encoded string of public key to be used for encryption
+            Returns: dict, the re-encrypted access key or error for the public key
+        '''
+        try:
+            encryption = encrypt_access_key(access_key, base64.b64decode(public_key))
+            if type(encryption) is not bytes:
+                return {'error': f'There was an error: {encryption["error"]}'}
+            return {'result': base64.b64encode(encryption).decode()}
+        except Exception as e:
+            return {'error': f'There was an error: {e}'}
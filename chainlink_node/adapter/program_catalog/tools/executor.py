@@ -0,0 +1,136 @@
+import os
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+# number of processes CPU-bound stages are sent to, 0 runs them inline on the calling greenlet
+CPU_POOL_WORKERS = int(os.environ.get('CPU_POOL_WORKERS', 0))
+# how pool processes are started, spawn avoids forking a running gevent hub
+CPU_POOL_START_METHOD = os.environ.get('CPU_POOL_START_METHOD', 'spawn')
+# stages sent to the pool, others always run inline as pickling their series across processes costs more than it saves
+CPU_POOL_STAGES = tuple(stage.strip() for stage in os.environ.get('CPU_POOL_STAGES', 'crypto').split(',') if stage.strip())
+
+
+def _timed(function, args, kwargs):
+    ''' Runs a stage function and measures how long it ran for
+
+        Parameters: function (function), module-level function of the stage
+                    args (tuple), positional arguments of the function
+                    kwargs (dict), keyword arguments of the function
+        Returns: object, the result of the function
+                 float, seconds the function ran for
+    '''
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+class StageExecutor:
+    ''' Runs CPU-bound stages of a request (decryption, averaging, data operations)
+        and sends the configured ones (by default only decryption, whose arguments
+        are small keys and ciphertexts) to a pool of worker processes so that they do
+        not block the gevent event loop of the web worker, while I/O stays on
+        greenlets. Waiting on a stage only blocks the calling greenlet. Functions and
+        their arguments are pickled, so stages must be module-level functions
+
+        The pool is created on first use in each process. Run counts, errors, time
+        spent running and waiting in the queue, and the number of stages in flight
+        are kept per stage
+    '''
+    def __init__(self, max_workers=CPU_POOL_WORKERS, start_method=CPU_POOL_START_METHOD, pooled_stages=CPU_POOL_STAGES):
+        ''' Parameters: max_workers (int), number of pool processes, 0 to run stages inline
+                        start_method (str), multiprocessing start method of the pool processes
+                        pooled_stages (tuple), names of the stages sent to the pool
+        '''
+        self._max_workers = max_workers
+        self._start_method = start_method
+        self._pooled_stages = frozenset(pooled_stages)
+        self._pool = None
+        self._pool_pid = None
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    def run(self, stage, function, *args, **kwargs):
+        ''' Runs a function as a named stage, in the pool if one is configured and
+            the stage is sent to it
+
+            Parameters: stage (str), name the stage is reported under
+                        function (function), module-level function to run
+                        args, kwargs, arguments of the function
+            Returns: object, the result of the function
+        '''
+        self._begin(stage)
+        submitted = time.perf_counter()
+        seconds = None
+        try:
+            if self._max_workers <= 0 or stage not in self._pooled_stages:
+                result, seconds = _timed(function, args, kwargs)
+            else:
+                result, seconds = self._get_pool().submit(_timed, function, args, kwargs).result()
+        except BrokenProcessPool:
+            self._reset_pool()
+            self._end(stage, submitted, seconds, failed=True)
+            raise
+        except Exception:
+            self._end(stage, submitted, seconds, failed=True)
+            raise
+        self._end(stage, submitted, seconds)
+        return result
+
+    def stats(self):
+        ''' Returns: dict, pool size, stages in flight and queued beyond the pool
+            size, and per-stage run counts and timings
+        '''
+        with self._lock:
+            stages = {stage: dict(counters) for stage, counters in self._stages.items()}
+        in_flight = sum(counters['in_flight'] for counters in stages.values())
+        pooled = sum(counters['in_flight'] for stage, counters in stages.items() if stage in self._pooled_stages)
+        return {
+            'workers': self._max_workers,
+            'pooled_stages': sorted(self._pooled_stages),
+            'in_flight': in_flight,
+            'queued': max(pooled - self._max_workers, 0) if self._max_workers > 0 else 0,
+            'stages': stages,
+        }
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                context = multiprocessing.get_context(self._start_method)
+                self._pool = ProcessPoolExecutor(max_workers=self._max_workers, mp_context=context)
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def _reset_pool(self):
+        ''' Drops a pool whose processes died so that the next stage starts a new one '''
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False)
+
+    def _begin(self, stage):
+        with self._lock:
+            counters = self._stages.setdefault(stage, {
+                'runs': 0, 'errors': 0, 'in_flight': 0,
+                'run_seconds': 0.0, 'max_run_seconds': 0.0, 'wait_seconds': 0.0,
+            })
+            counters['in_flight'] += 1
+
+    def _end(self, stage, submitted, seconds, failed=False):
+        elapsed = time.perf_counter() - submitted
+        with self._lock:
+            counters = self._stages[stage]
+            counters['in_flight'] -= 1
+            counters['runs'] += 1
+            if failed:
+                counters['errors'] += 1
+            if seconds is not None:
+                counters['run_seconds'] += seconds
+                counters['max_run_seconds'] = max(counters['max_run_seconds'], seconds)
+                counters['wait_seconds'] += max(elapsed - seconds, 0.0)
+
+
+CPU_EXECUTOR = StageExecutor()
@@ -0,0 +1,262 @@
+import os
+import threading
+import numpy as np
+import pandas as pd
+
+from program_catalog.tools.aggregation import as_arrays
+from program_catalog.tools.cache import LRUCache, window_positions
+
+
+# number of averaged series for which cumulative sums are kept
+PREFIX_SUM_CACHE_SIZE = int(os.environ.get('PREFIX_SUM_CACHE_SIZE', 128))
+# number of station histories for which covered date lookups are kept
+STATION_INDEX_CACHE_SIZE = int(os.environ.get('STATION_INDEX_CACHE_SIZE', 128))
+
+_NS_PER_DAY = 86400 * 10**9
+
+
+class PrefixSumIndex:
+    ''' Cumulative sum representation of a time series. The sum of the series over
+        any closed date window, skipping NaN values as Pandas does, is the difference
+        of two entries found by binary search. Sums are accumulated in extended
+        precision to keep window sums close to summing the window directly, but as
+        they are not bit-for-bit equal (and extended precision is platform-dependent)
+        they are used for backtests and analytics only; settlement sums the window
+    '''
+    def __init__(self, times, values, cumulative):
+        ''' Parameters: times (numpy array), sorted int64 nanosecond timestamps
+                        values (numpy array), float64 values of the series
+                        cumulative (numpy array), running sums with a leading 0
+        '''
+        self._times = times
+        self._values = values
+        self._cumulative = cumulative
+
+    @classmethod
+    def from_series(cls, series):
+        ''' Builds the index for a series
+
+            Parameters: series (Pandas Series), time series with a sorted DatetimeIndex
+            Returns: PrefixSumIndex, the index of the series
+        '''
+        times, values, _ = as_arrays(series)
+        return cls(times, values, cls._cumulate(values, 0))
+
+    @staticmethod
+    def _cumulate(values, offset):
+        ''' Returns: numpy array, running sums of the non-NaN values starting from offset '''
+        cumulative = np.empty(len(values) + 1, dtype=np.longdouble)
+        cumulative[0] = offset
+        np.cumsum(np.where(np.isnan(values), 0, values), dtype=np.longdouble, out=cumulative[1:])
+        cumulative[1:] += offset
+        return cumulative
+
+    def __len__(self):
+        return len(self._times)
+
+    @property
+    def bounds(self):
+        ''' Returns: tuple, first and last (naive UTC) timestamps of the series '''
+        return tuple(pd.Timestamp(time) for time in self._times[[0, -1]].view('datetime64[ns]'))
+
+    def window_sum(self, start, end):
+        ''' Sums the series over a closed date window for settlement. The window is
+            found by binary search and its float64 values are summed directly with
+            NaN filled with 0, exactly as Pandas sums series.loc[start:end], so that
+            payouts are reproducible across nodes and match evaluating the history
+
+            Parameters: start (str or Timestamp), first date of the window, naive dates are read as UTC
+                        end (str or Timestamp), last date of the window
+            Returns: float, the sum of the non-NaN values in the window
+        '''
+        first, last = window_positions(self._times, (start, end))
+        values = self._values[first:max(last, first)]
+        return float(np.where(np.isnan(values), 0, values).sum())
+
+    def window_sums(self, starts, ends):
+        ''' Sums the series over many closed windows at once from the prefix sums,
+            for backtests and analytics
+
+            Parameters: starts (numpy array), datetime64 first dates of the windows
+                        ends (numpy array), datetime64 last dates of the windows
+            Returns: numpy array, float64 sums of the non-NaN values in each window
+        '''
+        lower = np.searchsorted(self._times, np.asarray(starts, dtype='datetime64[ns]').view('<i8'), side='left')
+        upper = np.searchsorted(self._times, np.asarray(ends, dtype='datetime64[ns]').view('<i8'), side='right')
+        upper = np.maximum(upper, lower)
+        return (self._cumulative[upper] - self._cumulative[lower]).astype('<f8')
+
+    def extend(self, tail):
+        ''' Builds the index of a newer version of the series from its tail, reusing
+            the running sums if the newer version only appends to this one
+
+            Parameters: tail (Pandas Series), newer version of the series from any
+            timestamp of this one onwards
+            Returns: PrefixSumIndex, the index of the newer series, or None if the tail
+            does not overlap this series or changes any of its values
+        '''
+        times, values, _ = as_arrays(tail)
+        start = int(np.searchsorted(self._times, times[0])) if len(times) > 0 else len(self._times)
+        n = len(self._times) - start
+        if n == 0 or len(times) < n or not np.array_equal(times[:n], self._times[start:]) \
+                or not np.array_equal(values[:n], self._values[start:], equal_nan=True):
+            return None
+        tail_sums = self._cumulate(values[n:], self._cumulative[-1])
+        return PrefixSumIndex(np.concatenate([self._times, times[n:]]), np.concatenate([self._values, values[n:]]),
+                              np.concatenate([self._cumulative, tail_sums[1:]]))
+
+
+class PrefixSumCache:
+    ''' In-memory cache of prefix sum indexes keyed by the identity of an averaged
+        series (dataset and location list). Each entry remembers the dataset head it
+        was built from; when the head advances the entry is extended with the newly
+        appended days instead of being rebuilt, in the background so that requests
+        are not held up by it
+    '''
+    def __init__(self, max_size=PREFIX_SUM_CACHE_SIZE):
+        self._entries = LRUCache(max_size)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def get(self, identity, head):
+        ''' Gets the index of a series if it was built from the given dataset head
+
+            Parameters: identity (tuple), hashable identity of the averaged series
+                        head (str), current head hash of the dataset
+            Returns: PrefixSumIndex, the index or None if missing or stale
+        '''
+        entry = self._entries.get(identity)
+        if entry is None or head is None or entry[0] != head:
+            return None
+        return entry[1]
+
+    def get_stale(self, identity, head):
+        ''' Returns: PrefixSumIndex, the index of the series built from an older dataset head or None '''
+        entry = self._entries.get(identity)
+        return entry[1] if entry is not None and entry[0] != head else None
+
+    def put(self, identity, head, index):
+        ''' Stores the index of a series built from the given dataset head, unless the head is None '''
+        if head is not None:
+            self._entries.put(identity, (head, index))
+
+    def refresh(self, identity, build):
+        ''' Brings the index of a series up to date on a background thread (a greenlet
+            under the gevent workers), at most once at a time per series
+
+            Parameters: identity (tuple), hashable identity of the averaged series
+                        build (function), loads the series and stores its index
+        '''
+        with self._lock:
+            if identity in self._refreshing:
+                return
+            self._refreshing.add(identity)
+
+        def run():
+            try:
+                build()
+            except Exception as e:
+                print(f'could not refresh prefix sums of {identity}: {e}', flush=True)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(identity)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def stats(self):
+        return {**self._entries.stats(), 'refreshing': len(self._refreshing)}
+
+
+PREFIX_SUMS = PrefixSumCache()
+
+
+def parse_dates(dates):
+    ''' Parses ISO date strings to day ordinals in one vectorized pass
+
+        Parameters: dates (list), date strings formatted as %Y-%m-%d
+        Returns: numpy array, int64 days since the unix epoch
+    '''
+    return np.array(dates, dtype='datetime64[D]').view('<i8')
+
+
+class DailyMaxIndex:
+    ''' Lookup structure for maxima of a daily station history over arbitrary sets
+        of dates. The history is held as sorted int64 day ordinals and float values
+        (days with several observations keep their maximum), so a covered date set
+        is located with one binary search and reduced with a boolean mask instead
+        of re-indexing the history for every contract
+    '''
+    def __init__(self, days, values):
+        ''' Parameters: days (numpy array), sorted unique int64 days since the unix epoch
+                        values (numpy array), float64 maximum value observed on each day
+        '''
+        self._days = days
+        self._values = values
+
+    @classmethod
+    def from_series(cls, series):
+        ''' Builds the index for a daily history
+
+            Parameters: series (Pandas Series), time series with a sorted DatetimeIndex
+            Returns: DailyMaxIndex, the index of the series
+        '''
+        times, values, _ = as_arrays(series)
+        days = np.floor_divide(times, _NS_PER_DAY)
+        if len(days) > 1 and (np.diff(days) == 0).any():
+            starts = np.flatnonzero(np.concatenate([[True], np.diff(days) != 0]))
+            # NaN observations are skipped unless a day has no other value
+            values = np.fmax.reduceat(values, starts)
+            days = days[starts]
+        return cls(days, values)
+
+    @property
+    def span(self):
+        ''' Returns: tuple, int64 day ordinals of the first and last day of the history '''
+        return int(self._days[0]), int(self._days[-1])
+
+    def mask(self, dates):
+        ''' Marks the days of the history that fall on the given dates
+
+            Parameters: dates (list or numpy array), date strings or int64 day ordinals
+            Returns: numpy array, boolean mask over the days of the history
+        '''
+        days = parse_dates(dates) if not np.issubdtype(np.asarray(dates).dtype, np.integer) else np.asarray(dates)
+        positions = np.searchsorted(self._days, days)
+        found = positions < len(self._days)
+        found[found] = self._days[positions[found]] == days[found]
+        if not found.all():
+            missing = np.asarray(days[~found]).astype('datetime64[D]')
+            raise KeyError(f'{[str(day) for day in missing]} not in index')
+        mask = np.zeros(len(self._days), dtype=bool)
+        mask[positions] = True
+        return mask
+
+    def max_over(self, dates):
+        ''' Computes the maximum of the history over a set of dates, skipping NaN values
+
+            Parameters: dates (list or numpy array), date strings or int64 day ordinals,
+            all of which must be in the history
+            Returns: float, the maximum value over the dates
+        '''
+        values = self._values[self.mask(dates)]
+        if len(values) == 0 or np.isnan(values).all():
+            return np.nan
+        return float(np.nanmax(values))
+
+    def max_over_rows(self, days, valid):
+        ''' Computes the maximum of the history over each row of a table of date sets
+            in one vectorized pass, skipping NaN values as max_over does
+
+            Parameters: days (numpy array), 2-D int64 day ordinals, one row per date set
+                        valid (numpy array), boolean mask of the entries of days to include
+            Returns: numpy array, float64 maximum over each row, NaN for rows with an
+            included date that is not in the history or without any value
+        '''
+        positions = np.minimum(np.searchsorted(self._days, days), len(self._days) - 1)
+        found = self._days[positions] == days
+        values = np.where(valid & found, self._values[positions], np.nan)
+        maxima = np.fmax.reduce(values, axis=1)
+        return np.where((found | ~valid).all(axis=1), maxima, np.nan)
+
+
+STATION_INDEXES = LRUCache(STATION_INDEX_CACHE_SIZE)
@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from program_catalog.tools.cache import LRUCache, SingleFlight
+
+
+# job run ledger defaults, a size of 0 disables the ledger
+JOB_RUN_LEDGER_SIZE = int(os.environ.get('JOB_RUN_LEDGER_SIZE', 4096))
+JOB_RUN_LEDGER_TTL = float(os.environ.get('JOB_RUN_LEDGER_TTL', 3600))
+# SQLite file finished results are also written to so they survive worker restarts, unset keeps them in memory only
+JOB_RUN_LEDGER_PATH = os.environ.get('JOB_RUN_LEDGER_PATH', None)
+
+
+class JobRunLedger:
+    ''' Idempotent record of adapter results by Chainlink job run. The node retries
+        a bridge call that times out with the same jobRunID and body, so results are
+        keyed by the adapter, the jobRunID and a hash of the request data: duplicates
+        arriving while a run is in flight wait on it (single-flight) and retries
+        after it finishes are served the recorded result
+
+        Only results of adapters reporting success are recorded, so a retry after
+        a failure computes again (the /api adapter reports errors with status code
+        200, so the status code can not tell them apart). Entries expire after a TTL, are bounded in number,
+        and are optionally written through to a SQLite file shared by the workers
+    '''
+    def __init__(self, max_size=JOB_RUN_LEDGER_SIZE, ttl=JOB_RUN_LEDGER_TTL, path=JOB_RUN_LEDGER_PATH):
+        ''' Parameters: max_size (int), number of results kept, 0 to disable the ledger
+                        ttl (float), seconds for which results are served on retries
+                        path (str), SQLite file to persist results to or None
+        '''
+        self._max_size = max_size
+        self._ttl = ttl
+        self._path = path
+        self._results = LRUCache(max_size)
+        self._flights = SingleFlight()
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_pid = None
+
+    @property
+    def enabled(self):
+        return self._max_size > 0
+
+    def key(self, adapter_class, data):
+        ''' Builds the ledger key of a request
+
+            Parameters: adapter_class (class), adapter the request is routed to
+                        data (dict), the received request body
+            Returns: str, key of the request or None if it has no jobRunID or the ledger is disabled
+        '''
+        if not self.enabled or not isinstance(data, dict) or data.get('id') is None:
+            return None
+        serialized = json.dumps(data.get('data'), sort_keys=True, default=str)
+        digest = hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+        return f'{adapter_class.__name__}:{data["id"]}:{digest}'
+
+    def get(self, key):
+        ''' Gets the recorded result of a finished job run
+
+            Parameters: key (str), ledger key of the request
+            Returns: dict, the recorded result or None if there is none or it expired
+        '''
+        if key is None:
+            return None
+        entry = self._results.get(key)
+        if entry is None and self._path is not None:
+            entry = self._load(key)
+            if entry is not None:
+                self._results.put(key, entry)
+        if entry is None or time.time() - entry[0] > self._ttl:
+            return None
+        return entry[1]
+
+    def in_flight(self, key):
+        ''' Returns: bool, whether the job run of a key is being computed in this worker '''
+        return key is not None and self._flights.in_flight(key)
+
+    def run(self, key, compute):
+        ''' Gets the result of a job run, computing it once however many duplicate
+            requests for it arrive at the same time
+
+            Parameters: key (str), ledger key of the request or None to always compute
+                        compute (function), returns the adapter result and whether it succeeded
+            Returns: dict, the adapter result
+        '''
+        if key is None:
+            return compute()[0]
+        result = self.get(key)
+        if result is not None:
+            return result
+        return self._flights.do(key, lambda: self._compute(key, compute))
+
+    def _compute(self, key, compute):
+        result, succeeded = compute()
+        if succeeded:
+            self._record(key, result)
+        return result
+
+    def stats(self):
+        ''' Returns: dict, hit and miss counts, size, job runs in flight and coalesced duplicates '''
+        flights = self._flights.stats()
+        return {**self._results.stats(), 'in_flight': flights['in_flight'], 'coalesced': flights['coalesced']}
+
+    def _record(self, key, result):
+        entry = (time.time(), result)
+        self._results.put(key, entry)
+        if self._path is None:
+            return
+        try:
+            with self._lock:
+                db = self._connect()
+                db.execute('INSERT OR REPLACE INTO job_runs (key, created, result) VALUES (?, ?, ?)', (key, entry[0], json.dumps(result, default=str)))
+                db.execute('DELETE FROM job_runs WHERE created < ?', (entry[0] - self._ttl,))
+                db.execute('DELETE FROM job_runs WHERE key NOT IN (SELECT key FROM job_runs ORDER BY created DESC LIMIT ?)', (self._max_size,))
+                db.commit()
+        except sqlite3.Error as e:
+            print(f'could not persist job run {key}: {e}', flush=True)
+
+    def _load(self, key):
+        try:
+            with self._lock:
+                row = self._connect().execute('SELECT created, result FROM job_runs WHERE key = ?', (key,)).fetchone()
+        except sqlite3.Error as e:
+            print(f'could not read job run {key}: {e}', flush=True)
+            return None
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def _connect(self):
+        ''' Opens the SQLite file once per process, call with the lock held '''
+        if self._db is None or self._db_pid != os.getpid():
+            directory = os.path.dirname(self._path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(self._path, timeout=5, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS job_runs (key TEXT PRIMARY KEY, created REAL, result TEXT)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS job_runs_created ON job_runs (created)')
+            self._db_pid = os.getpid()
+        return self._db
+
+
+LEDGER = JobRunLedger()
@@ -1,10 +1,33 @@
+import os
 import ast
+import time
+import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, FIRST_EXCEPTION, wait
 
 from dweather.dweather_client import client
+from program_catalog.tools.aggregation import RunningAverage, average_series
+from program_catalog.tools.cache import DATASET_HEADS, HISTORY_CACHE, get_head, history_key_parts
+from program_catalog.tools.executor import CPU_EXECUTOR
+from program_catalog.tools.indices import STATION_INDEXES, DailyMaxIndex, parse_dates
 
 
+# concurrent fetch defaults, threads are cooperative greenlets under the gevent workers
+FETCH_WORKERS = int(os.environ.get('GRIDCELL_FETCH_WORKERS', 8))
+FETCH_TIMEOUT = float(os.environ.get('GRIDCELL_FETCH_TIMEOUT', 240))
+# number of grid cells from which histories are folded into the average as they arrive
+STREAMING_THRESHOLD = int(os.environ.get('GRIDCELL_STREAMING_THRESHOLD', 64))
+# fraction of a grid cell around cell boundaries within which locations are not merged with others
+SNAP_TOLERANCE = 1e-3
+# padding on windowed loads, covers any offset from converting to local time
+WINDOW_PADDING = timedelta(days=1)
+
+
+class SnapMismatchError(Exception):
+    ''' Raised when a dataset snaps a location to a different grid cell than expected '''
+    pass
+
 
 def parse_timestamp(timestamp):
     ''' Helper funciton to parse timestamps to Pandas-readable date strings 
@@ -46,13 +69,20 @@ class GridcellLoader(DClimateLoader):
         to get historical gridcell data from IPFS for specified locations and
         computes single time series averaged over all locations
     '''
-    def __init__(self, locations, dataset_name, imperial_units=True, **kwargs):
+    def __init__(self, locations, dataset_name, imperial_units=True, max_workers=FETCH_WORKERS, fetch_timeout=FETCH_TIMEOUT, window=None, streaming=None, **kwargs):
         ''' On initialization each Loader instance sets the locations for which to
             get the historical weather data and the dataset to pull from
 
             Parameters: locations (str), string of list of lat/lon coordinate pairs as strings
                         dataset_name (str), the name of the dataset on IPFS
                         imperial_units (bool), whether to use imperial units
+                        max_workers (int), number of locations to fetch concurrently (1 to fetch sequentially)
+                        fetch_timeout (float), seconds to wait on all location fetches of a load
+                        window (tuple), optional (start, end) date strings to restrict loaded
+            histories to, padded by a day on each side to cover local time conversion,
+            either may be None for an open bound
+                        streaming (bool), whether to fold each history into a running average
+            as it arrives instead of holding all of them, by default only for large location lists
                         kwargs (dict), additional request parameters
         '''
         super().__init__(dataset_name, imperial_units=imperial_units, **kwargs)
@@ -60,36 +90,242 @@ class GridcellLoader(DClimateLoader):
             self._locations = ast.literal_eval(locations)
         else:
             self._locations = locations
+        self._max_workers = int(max_workers)
+        self._fetch_timeout = float(fetch_timeout) if fetch_timeout is not None else None
+        if window is not None:
+            start, end = window
+            window = (pd.Timestamp(start) - WINDOW_PADDING if start is not None else None,
+                      pd.Timestamp(end) + WINDOW_PADDING if end is not None else None)
+        self._window = window
+        self._streaming = streaming
 
     def load(self):
-        ''' Loads the weather data time series from IPFS for each specified
-            location and averages the desired quantities to produce a single
-            time series of historical averages
+        ''' Loads the weather data time series from IPFS for each grid cell
+            covered by the specified locations and averages the desired quantities
+            to produce a single time series of historical averages. Locations that
+            snap to the same grid cell are fetched once, and the shared history is
+            counted once per location in the order of the locations, so that the
+            average matches averaging the history of every location
 
             Returns: Pandas Series, time series for desired weather data averaged
             across all locations specified during initialization
         '''
+        cells, locations, assignment = self._snap_locations()
+        streaming = self._streaming if self._streaming is not None else len(cells) >= STREAMING_THRESHOLD
+        load = self._load_streaming if streaming else self._load_average
+        try:
+            result = load(cells, locations, assignment)
+        except SnapMismatchError as e:
+            print(f'{e}, fetching all locations', flush=True)
+            result = load(*self._unsnapped())
+        return result
+
+    def _load_average(self, cells, locations, assignment):
+        ''' Loads the series for every cell and averages them all at once
+
+            Parameters: cells (list), predicted grid cell of each fetch or None
+                        locations (list), (lat, lon) location fetched for each cell
+                        assignment (list), index of the cell of each original location
+            Returns: Pandas Series, time series of averages
+        '''
+        gridcell_histories = self._load_cells(cells, locations)
+        result = CPU_EXECUTOR.run('aggregation', average_series, [gridcell_histories[index] for index in assignment])
+        return result
+
+    def _load_streaming(self, cells, locations, assignment):
+        ''' Loads the series for the locations ahead of the running average, at most
+            two cells per worker at a time, and folds them into the average once per
+            original location in the order of the locations. A series is released as
+            soon as no location within that window uses it, so memory is bounded by
+            the window rather than the number of cells; a cell used again further on
+            is loaded again, from the history cache when it is enabled
+
+            Parameters: cells (list), predicted grid cell of each fetch or None
+                        locations (list), (lat, lon) location fetched for each cell
+                        assignment (list), index of the cell of each original location
+            Returns: Pandas Series, time series of averages
+        '''
+        max_workers = max(1, min(self._max_workers, len(cells)))
+        average = RunningAverage()
+        futures = {}
+        uses = {}
+        submitted = 0
+        deadline = self._deadline()
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            for position, index in enumerate(assignment):
+                # extend the window of upcoming locations while it spans fewer than two cells per worker
+                while submitted < len(assignment):
+                    upcoming = assignment[submitted]
+                    if upcoming not in futures:
+                        if len(futures) >= 2 * max_workers:
+                            break
+                        futures[upcoming] = executor.submit(self._load_cell, locations[upcoming], cells[upcoming])
+                    uses[upcoming] = uses.get(upcoming, 0) + 1
+                    submitted += 1
+                while True:
+                    for future in futures.values():
+                        if future.done() and future.exception() is not None:
+                            raise future.exception()
+                    if futures[index].done():
+                        break
+                    done, _ = wait([future for future in futures.values() if not future.done()],
+                                   timeout=self._remaining(deadline), return_when=FIRST_COMPLETED)
+                    if not done:
+                        raise TimeoutError(f'Gridcell fetches exceeded {self._fetch_timeout} seconds')
+                average.add(futures[index].result())
+                uses[index] -= 1
+                if uses[index] == 0:
+                    del uses[index], futures[index]
+            return average.result()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _snap_locations(self):
+        ''' Resolves each location to the grid cell of the dataset it falls in using
+            the grid resolution and lat/lon ranges in the dataset metadata. Locations
+            within SNAP_TOLERANCE of a cell boundary or outside the grid could be
+            snapped to a neighbouring cell by the dataset, so they are not merged with
+            other locations and are fetched on their own
+
+            Returns: list, predicted (lat, lon) grid cell of each fetch in order of
+            first appearance, or None for a location fetched on its own (every location
+            if the dataset metadata can not be read or does not describe a grid)
+                     list, (lat, lon) location fetched for each cell, the first location in it
+                     list, index of the cell of each location, in the order of the locations
+        '''
+        try:
+            _, metadata = DATASET_HEADS.get_metadata(self._dataset_name)
+        except Exception as e:
+            print(f'could not get metadata for {self._dataset_name}: {e}, fetching all locations', flush=True)
+            return self._unsnapped()
+        try:
+            resolution = float(metadata['resolution'])
+            min_lat, max_lat = float(metadata['latitude range'][0]), float(metadata['latitude range'][-1])
+            min_lon, max_lon = float(metadata['longitude range'][0]), float(metadata['longitude range'][-1])
+        except (KeyError, IndexError, TypeError, ValueError):
+            return self._unsnapped()
+        cells = []
+        indices = {}
+        locations = []
+        assignment = []
+        for location in self._locations:
+            lat, lon = float(location[0]), float(location[1])
+            if min_lon >= 0 and lon < 0:
+                lon += 360
+            steps = ((lat - min_lat) / resolution, (lon - min_lon) / resolution)
+            limits = ((max_lat - min_lat) / resolution, (max_lon - min_lon) / resolution)
+            if any(abs(abs(step - round(step)) - 0.5) < SNAP_TOLERANCE or not -0.5 < step < limit + 0.5
+                   for step, limit in zip(steps, limits)):
+                assignment.append(len(cells))
+                cells.append(None)
+                locations.append(tuple(location))
+                continue
+            cell = (round(round(steps[0]) * resolution + min_lat, 3), round(round(steps[1]) * resolution + min_lon, 3))
+            if cell not in indices:
+                indices[cell] = len(cells)
+                cells.append(cell)
+                locations.append(tuple(location))
+            assignment.append(indices[cell])
+        return cells, locations, assignment
+
+    def _unsnapped(self):
+        ''' Returns: list, None for each location, so that every location is fetched on its own
+                     list, (lat, lon) of each location
+                     list, index of each location
+        '''
+        locations = [tuple(location) for location in self._locations]
+        return [None] * len(locations), locations, list(range(len(locations)))
+
+    def _load_cells(self, cells, locations):
+        ''' Loads the series for each grid cell, concurrently if configured
+
+            Parameters: cells (list), predicted grid cell of each fetch or None
+                        locations (list), (lat, lon) location fetched for each cell
+            Returns: list, Pandas Series for each cell in the order given
+        '''
+        if self._max_workers > 1 and len(cells) > 1:
+            return self._load_concurrently(cells, locations)
         gridcell_histories = []
-        for (lat, lon) in self._locations:
-            series = self._load_series(lat, lon)
+        for location, cell in zip(locations, cells):
+            series = self._load_cell(location, cell)
             gridcell_histories.append(series)
-        df = pd.concat(gridcell_histories, axis=1)
-        result = pd.Series(df.mean(axis=1))
-        return result
+        return gridcell_histories
 
-    def _load_series(self, lat, lon):
-        ''' Loads a Pandas Series from IPFS for a given lat/lon coordinate pair
+    def _load_concurrently(self, cells, locations):
+        ''' Loads the series for every cell on a pool of worker threads,
+            failing fast on the first cell that errors or comes back empty, or
+            once all cells together exceed the fetch timeout
+
+            Parameters: cells (list), predicted grid cell of each fetch or None
+                        locations (list), (lat, lon) location fetched for each cell
+            Returns: list, Pandas Series for each cell in the order given
+        '''
+        deadline = self._deadline()
+        executor = ThreadPoolExecutor(max_workers=min(self._max_workers, len(cells)))
+        try:
+            futures = [executor.submit(self._load_cell, location, cell) for location, cell in zip(locations, cells)]
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, timeout=self._remaining(deadline), return_when=FIRST_EXCEPTION)
+                if not done:
+                    raise TimeoutError(f'Gridcell fetches exceeded {self._fetch_timeout} seconds')
+                for future in done:
+                    if future.exception() is not None:
+                        raise future.exception()
+            return [future.result() for future in futures]
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _deadline(self):
+        ''' Returns: float, monotonic time by which all fetches of a load must finish, or None '''
+        return time.monotonic() + self._fetch_timeout if self._fetch_timeout is not None else None
+
+    @staticmethod
+    def _remaining(deadline):
+        ''' Returns: float, seconds left until the deadline (0 once it has passed), or None '''
+        return max(deadline - time.monotonic(), 0) if deadline is not None else None
+
+    def _load_cell(self, location, cell):
+        ''' Loads the series for an original location and, if a grid cell was
+            predicted for it, checks that the dataset snapped it to that cell. A
+            location assigned to the wrong cell (on a cell boundary or through
+            float error) raises a SnapMismatchError
+
+            Parameters: location (tuple), (lat, lon) location as given in the request
+                        cell (tuple), predicted (lat, lon) grid cell or None
+            Returns: Pandas Series, historical weather data for the location
+        '''
+        lat, lon = location
+        data = self._load_history(lat, lon)
+        snapped = data.get('snapped to', None)
+        if cell is not None and snapped is not None:
+            snapped_lat, snapped_lon = (float(coordinate) for coordinate in snapped)
+            if abs(snapped_lat - cell[0]) > 1e-6 or abs((snapped_lon - cell[1] + 180) % 360 - 180) > 1e-6:
+                raise SnapMismatchError(f'location ({lat}, {lon}) snapped to ({snapped_lat}, {snapped_lon}) instead of {cell}')
+        return data['data']
+
+    def _load_history(self, lat, lon):
+        ''' Loads the history for a given lat/lon coordinate pair along with the
+            coordinates it was snapped to
 
             Parameters: lat (float), latitude of location
                         lon (float), longitude of location
-            Returns: Pandas Series, historical weather data for the given location
+            Returns: dict, historical weather data under key "data" and the
+            snapped coordinates under key "snapped to"
         '''
-        data = client.get_gridcell_history(lat, lon, self._dataset_name, **self._request_params)
-        series = data['data']
-        if series.empty:
-            raise ValueError('No data returned for request')
-        series = series.set_axis(pd.to_datetime(series.index, utc=True)).sort_index()
-        return series
+        request_params = {**self._request_params, 'also_return_snapped_coordinates': True}
+
+        def fetch():
+            data = client.get_gridcell_history(lat, lon, self._dataset_name, **request_params)
+            series = data['data']
+            if series.empty:
+                raise ValueError('No data returned for request')
+            data['data'] = series.set_axis(pd.to_datetime(series.index, utc=True)).sort_index()
+            return data
+
+        key_parts = history_key_parts(get_head(self._dataset_name), 'get_gridcell_history', lat, lon, self._dataset_name, **request_params)
+        return HISTORY_CACHE.load(key_parts, fetch, window=self._window)
 
 
 class StationLoader(DClimateLoader):
@@ -115,7 +351,15 @@ class StationLoader(DClimateLoader):
         self._weather_variable = weather_variable
         dates = ast.literal_eval(dates)
         start_date = datetime(2022, 2, 18)
-        self._dates = [date for date in dates if datetime.strptime(date, '%Y-%m-%d') < (start_date + timedelta(days=15))]
+        cutoff = np.datetime64(start_date + timedelta(days=15), 'D').astype('<i8')
+        days = parse_dates(dates)
+        self._dates = [date for date, covered in zip(dates, days < cutoff) if covered]
+        self._days = days[days < cutoff]
+
+    @property
+    def dates(self):
+        ''' Returns: list, covered date strings before the evaluation cutoff, in request order '''
+        return list(self._dates)
 
     def load(self):
         ''' Loads the dataset history from IPFS for the specified station ID
@@ -123,10 +367,48 @@ class StationLoader(DClimateLoader):
 
             Returns: Pandas Series, time series for station weather data for covered dates
         '''
-        data = client.get_station_history(self._station_id, self._weather_variable, **self._request_params)
-        series = data['data']
-        if series.empty:
-            raise ValueError('No data returned for request')
-        series = series.set_axis(pd.to_datetime(series.index)).sort_index()
+        series = self.load_history()
         covered_dates = series.loc[self._dates]
-        return covered_dates
\ No newline at end of file
+        return covered_dates
+
+    def load_index(self):
+        ''' Gets the covered date lookup structure for the station history, building
+            it once per dataset head, station, weather variable and request parameters
+
+            Returns: DailyMaxIndex, lookup structure for maxima over covered dates
+        '''
+        key_parts = self._history_key_parts()
+        key = HISTORY_CACHE.key(*key_parts)
+        index = STATION_INDEXES.get(key)
+        if index is None:
+            index = DailyMaxIndex.from_series(self.load_history())
+            if key_parts[0] is not None:
+                STATION_INDEXES.put(key, index)
+        return index
+
+    def max_over_dates(self):
+        ''' Computes the maximum station value over the covered dates
+
+            Returns: float, maximum weather value over the covered dates
+        '''
+        return self.load_index().max_over(self._days)
+
+    def load_history(self):
+        ''' Loads the full dataset history from IPFS for the specified station ID
+            and weather variable
+
+            Returns: Pandas Series, time series for station weather data
+        '''
+        def fetch():
+            data = client.get_station_history(self._station_id, self._weather_variable, **self._request_params)
+            series = data['data']
+            if series.empty:
+                raise ValueError('No data returned for request')
+            data['data'] = series.set_axis(pd.to_datetime(series.index)).sort_index()
+            return data
+
+        return HISTORY_CACHE.load(self._history_key_parts(), fetch)['data']
+
+    def _history_key_parts(self):
+        ''' Returns: tuple, key parts of the station history, shared by the history cache and its lookup structures '''
+        return history_key_parts(get_head(self._dataset_name), 'get_station_history', self._station_id, self._weather_variable, **self._request_params)
@@ -0,0 +1,168 @@
+import os
+import io
+import ast
+import numpy as np
+import pandas as pd
+from datetime import timezone, datetime, date, time
+
+from program_catalog.tools.cache import LRUCache
+
+
+# number of compiled operation plans kept per worker
+OPERATION_PLAN_CACHE_SIZE = int(os.environ.get('OPERATION_PLAN_CACHE_SIZE', 512))
+
+# operations reducing a series (or a resampled or rolling window) to values
+REDUCTIONS = frozenset([
+    'sum', 'mean', 'median', 'max', 'min', 'std', 'var', 'count', 'quantile',
+    'idxmax', 'idxmin', 'nunique', 'first_valid_index', 'last_valid_index',
+])
+# operations transforming a series into another series or into windows of it
+TRANSFORMS = frozenset([
+    'resample', 'rolling', 'expanding', 'diff', 'cumsum', 'cummax', 'cummin', 'abs', 'dropna',
+    'fillna', 'ffill', 'bfill', 'interpolate', 'shift', 'pct_change', 'clip', 'round', 'head', 'tail',
+    'first', 'last', 'gt', 'ge', 'lt', 'le', 'eq', 'ne',
+])
+# operations the installed Pandas no longer provides (Series.first and Series.last were removed in
+# Pandas 3) are left out, so that they are rejected when a plan is compiled instead of when it runs
+SUPPORTED_OPERATIONS = frozenset(op for op in REDUCTIONS | TRANSFORMS if hasattr(pd.Series, op))
+
+PLANS = LRUCache(OPERATION_PLAN_CACHE_SIZE)
+
+
+def compile_plan(ops, params):
+    ''' Validates the operations of a request against the supported operations and
+        parses their parameters once. Plans are cached by their operations and
+        parameters, as oracle requests repeat them verbatim
+
+        Each parameter is a list literal (or a list) whose first two entries are
+        whether to return the result of the operation and whether to carry it
+        forward to the next operation, followed by the arguments of the operation
+
+        Parameters: ops (list), names of the operations to chain
+                    params (list), parameters of each operation
+        Returns: tuple, (operation, arguments, return result, carry forward) for each operation
+    '''
+    if not isinstance(ops, (list, tuple)) or not isinstance(params, (list, tuple)):
+        raise ValueError('request operations and parameters must be lists')
+    key = (tuple(str(op) for op in ops), tuple(param if isinstance(param, str) else repr(param) for param in params))
+    plan = PLANS.get(key)
+    if plan is None:
+        plan = _compile(ops, params)
+        PLANS.put(key, plan)
+    return plan
+
+
+def _compile(ops, params):
+    if len(params) < len(ops):
+        raise ValueError('missing parameters for request operations')
+    plan = []
+    for op, param in zip(ops, params):
+        if op not in SUPPORTED_OPERATIONS:
+            raise ValueError(f'Unsupported operation {op}')
+        try:
+            op_params = ast.literal_eval(param) if isinstance(param, str) else param
+        except (ValueError, SyntaxError):
+            raise ValueError(f'Improperly formatted parameters for operation {op}')
+        if not isinstance(op_params, (list, tuple)) or len(op_params) < 2:
+            raise ValueError(f'Improperly formatted parameters for operation {op}')
+        plan.append((op, tuple(op_params[2:]), bool(op_params[0]), bool(op_params[1])))
+    return tuple(plan)
+
+
+def run_plan(data, plan, all_results=False):
+    ''' Runs a compiled operation plan on the requested data. By default the result
+        of the first operation marked for return is returned, in multi-result mode
+        the chain runs to the end and the result of every such operation is returned
+
+        data is dict iff metadata and BytesIO iff CEDA (basically not supported)
+            and pd.Series/pd.DataFrame otherwise
+        18 digits of precision on decimals
+        times are returned as timestamps starting at beginning of unix epoch
+        dates are returned as timestamps starting at beginning of unix epoch to start of date
+        ms on timestamps
+
+        Parameters: data (object), data returned by the client wrapper of the request
+                    plan (tuple), plan returned by compile_plan
+                    all_results (bool), whether to return the results of all operations marked for return
+        Returns: int (or list), encoded result of the operation marked for return (0 on failure),
+                 or in multi-result mode the encoded results in order (empty on failure)
+                 str, error message or None
+    '''
+    failed = [] if all_results else 0
+    if type(data) is dict or type(data) is io.BytesIO:
+        return failed, "Request not supported"
+    reset = data
+    results = []
+    for op, op_args, return_result, carry_forward in plan:
+        result = _fast_reduction(data, op, op_args)
+        if result is None:
+            result = getattr(data, op)(*op_args)
+        if return_result:
+            encoded, msg = encode_result(result)
+            if not all_results:
+                return encoded, msg
+            if msg is not None:
+                return failed, msg
+            results.append(encoded)
+        if carry_forward:
+            data = result
+        else:
+            data = reset
+    if results:
+        return results, None
+    return failed, "No return specified"
+
+
+def _fast_reduction(data, op, op_args):
+    ''' Computes common reductions of a float series directly on its values, matching
+        the NaN handling of Pandas (sums fill NaN with 0, the others skip NaN and
+        give NaN if no value is left)
+
+        Returns: float, the reduction or None if there is no fast path for it
+    '''
+    if type(data) is not pd.Series or data.dtype.kind != 'f' or len(data) == 0:
+        return None
+    if op == 'quantile':
+        if len(op_args) > 1 or (len(op_args) == 1 and (isinstance(op_args[0], bool) or not isinstance(op_args[0], (int, float)))):
+            return None
+    elif op not in ('sum', 'mean', 'max', 'min') or len(op_args) > 0:
+        return None
+    values = data.to_numpy()
+    missing = np.isnan(values)
+    count = len(values) - np.count_nonzero(missing)
+    if op in ('sum', 'mean'):
+        total = values.sum() if count == len(values) else np.where(missing, 0, values).sum()
+        if op == 'sum':
+            return total
+        return total / count if count > 0 else np.float64(np.nan)
+    if count == 0:
+        return np.float64(np.nan)
+    present = values[~missing] if count < len(values) else values
+    if op == 'max':
+        return present.max()
+    if op == 'min':
+        return present.min()
+    q = op_args[0] if len(op_args) == 1 else 0.5
+    return np.percentile(present, q * 100)
+
+
+def encode_result(result):
+    ''' Encodes the result of an operation for the chain: series are averaged, dates
+        and times become millisecond timestamps and numbers are scaled by 10^18
+
+        Returns: int, encoded result (0 on failure)
+                 str, error message or None
+    '''
+    if type(result) is pd.Series or type(result) is pd.DataFrame:
+        result = result.mean()
+    if type(result) is date:
+        result = datetime(result.year, result.month, result.day)
+    if type(result) is time:
+        result = datetime(0, 0, 0, result.hour, result.minute, result.second, result.microsecond)
+    if type(result) is datetime:
+        return int(result.replace(tzinfo=timezone.utc).timestamp() * 1000), None
+    elif 'float' in str(type(result)) or 'int' in str(type(result)):
+        return int(float(result) * 1e18), None
+    else:
+        return 0, "Incompatible return type"
+
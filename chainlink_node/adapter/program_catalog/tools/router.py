@@ -0,0 +1,120 @@
+import os
+import re
+import ast
+from urllib.parse import urlsplit
+
+from program_catalog.tools.cache import LRUCache
+
+
+# number of parsed request URLs kept per worker
+ROUTER_CACHE_SIZE = int(os.environ.get('ROUTER_CACHE_SIZE', 1024))
+# parameters cast to floats whatever their documented type
+FLOAT_PARAMETERS = frozenset(['lat', 'lon', 'radius', 'max_lat', 'max_lon', 'min_lat', 'min_lon'])
+
+_SEPARATORS = re.compile('_|/')
+
+
+def _boolean(value):
+    ''' Converts a boolean query value, accepting any capitalization of true and false '''
+    lowered = value.lower()
+    if lowered == 'true':
+        return True
+    if lowered == 'false':
+        return False
+    return ast.literal_eval(value.capitalize())
+
+
+def _converter(name, param_type):
+    ''' Returns: function, converter of a secondary (query) parameter of the given
+        name and swagger type, or None if the value is kept as a string
+    '''
+    if name in FLOAT_PARAMETERS:
+        return float
+    if param_type == 'string':
+        return None
+    if param_type == 'boolean':
+        return _boolean
+    return ast.literal_eval
+
+
+class Router:
+    ''' Parses dClimate API request URLs into the arguments of the client wrapper of
+        their endpoint. API_MAP is compiled once into per-endpoint converters for the
+        primary (path) and secondary (query) parameters, and parsed URLs are kept in
+        a small LRU since Chainlink jobs repeat the same request URLs
+    '''
+    def __init__(self, api_map, max_size=ROUTER_CACHE_SIZE):
+        ''' Parameters: api_map (dict), endpoint map built from the swagger document
+                        max_size (int), number of parsed request URLs kept
+        '''
+        self._base_path = api_map['basePath']
+        self._endpoints = {key: self._compile(endpoint) for key, endpoint in api_map['paths'].items()}
+        self._parsed = LRUCache(max_size)
+
+    @staticmethod
+    def _compile(endpoint):
+        ''' Returns: dict, how to split the path of an endpoint and the converter
+            of each of its parameters
+        '''
+        return {
+            'by_dataset': 'dataset' in endpoint['primary'],
+            'primary': [(name, float if name in FLOAT_PARAMETERS else None) for name in endpoint['primary']],
+            'secondary': {name: _converter(name, endpoint['types'].get(name)) for name in endpoint['secondary']},
+        }
+
+    def parse(self, url):
+        ''' Parses a request URL
+
+            Parameters: url (str), request URL starting with the API base path
+            Returns: dict (or str), arguments for the endpoint wrapper including the
+            endpoint key under '_key', or an error message if the URL is invalid
+                     bool, whether the URL is valid
+        '''
+        parsed = self._parsed.get(url)
+        if parsed is None:
+            parsed = self._parse(url)
+            self._parsed.put(url, parsed)
+        args, valid = parsed
+        # callers pop '_key' and wrappers fill in defaults, so each gets its own copy
+        return (dict(args), True) if valid else parsed
+
+    def stats(self):
+        return self._parsed.stats()
+
+    def _parse(self, url):
+        # check basePath version
+        if not url.startswith(self._base_path):
+            return 'Incompatible API version, please use ' + self._base_path, False
+        request = urlsplit(url[len(self._base_path):])
+
+        # get endpoint
+        key, _, remainder = request.path.partition('/')
+        endpoint = self._endpoints.get(key, None)
+        if endpoint is None:
+            return 'Improperly formatted request URL, endpoint not found', False
+
+        # get primary parameters
+        if endpoint['by_dataset']:
+            dataset, _, remainder = remainder.partition('/')
+            params = [dataset] + ([param for segment in remainder.split('/') for param in segment.split('_')] if remainder else [])
+        else:
+            params = _SEPARATORS.split(remainder) if remainder else []
+        if len(params) != len(endpoint['primary']):
+            return 'Improperly formatted request URL, incompatible parameters', False
+
+        args = {}
+        try:
+            for (name, convert), value in zip(endpoint['primary'], params):
+                args[name] = convert(value) if convert is not None else value
+
+            # type check and set secondary parameters
+            for query in request.query.split('&') if request.query else []:
+                name, _, value = query.partition('=')
+                if name not in endpoint['secondary']:
+                    return 'Improperly formatted request URL, incompatible parameters', False
+                convert = endpoint['secondary'][name]
+                args[name] = convert(value) if convert is not None else value
+        except (ValueError, SyntaxError):
+            return f'Improperly formatted request URL, invalid value for {name}', False
+        args['_key'] = key
+        return args, True
@@ -1,12 +1,23 @@
 import io
-import json
-import re
+import os
 import ast
 import pandas as pd
+from functools import lru_cache
 from datetime import timezone, datetime, date, time
-from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
 
 from dweather.dweather_client import client, http_queries
+from program_catalog.tools.aggregation import combine_sources
+from program_catalog.tools.api_map import SWAGGER_PATH, load_api_map
+from program_catalog.tools.cache import DATASET_HEADS, HISTORY_CACHE, coalesced_fetch, get_head, history_key_parts
+from program_catalog.tools.executor import CPU_EXECUTOR
+from program_catalog.tools.operations import compile_plan, run_plan
+from program_catalog.tools.router import Router
+
+
+# multi-source request limits, sources are fetched concurrently on cooperative greenlets under the gevent workers
+MULTI_SOURCE_MAX_SOURCES = int(os.environ.get('MULTI_SOURCE_MAX_SOURCES', 8))
+MULTI_SOURCE_FETCH_TIMEOUT = float(os.environ.get('MULTI_SOURCE_FETCH_TIMEOUT', 240))
 
 
 '''
@@ -39,13 +50,13 @@ def get_forecasts_wrapper(args):
     ''' Returns dict with pd.Series '''
     default_args = {"also_return_metadata": False, "also_return_snapped_coordinates": True, "use_imperial_units": True, "desired_units": None, "ipfs_timeout": None, "convert_to_local_time": True}
     default_args.update(args)
-    data = client.get_forecast(**default_args)
+    data = coalesced_fetch(('get_forecast', default_args), lambda: client.get_forecast(**default_args))
     return data
 
 
 def get_drought_monitor_history_wrapper(args):
     ''' Returns dict with pd.Series '''
-    data = client.get_drought_monitor_history(**args)
+    data = coalesced_fetch(('get_drought_monitor_history', args), lambda: client.get_drought_monitor_history(**args))
     return data
 
  
@@ -53,7 +64,7 @@ def get_cme_station_history_wrapper(args):
     ''' Returns dict with pd.Series '''
     default_args = {"desired_units": None, "ipfs_timeout": None}
     default_args.update(args)
-    data = client.get_cme_station_history(**default_args)
+    data = coalesced_fetch(('get_cme_station_history', default_args), lambda: client.get_cme_station_history(**default_args))
     return data
 
 
@@ -61,7 +72,7 @@ def get_dutch_station_history_wrapper(args):
     ''' Returns dict with pd.Series '''
     default_args = {"dataset": "dutch_stations-daily", "desired_units": None, "ipfs_timeout": None}
     default_args.update(args)
-    data = client.get_european_station_history(**default_args)
+    data = coalesced_fetch(('get_european_station_history', default_args), lambda: client.get_european_station_history(**default_args))
     return data
 
 
@@ -69,7 +80,7 @@ def get_german_station_history_wrapper(args):
     ''' Returns dict with pd.Series '''
     default_args = {"dataset": "dwd_stations-daily", "desired_units": None, "ipfs_timeout": None}
     default_args.update(args)
-    data = client.get_european_station_history(**default_args)
+    data = coalesced_fetch(('get_european_station_history', default_args), lambda: client.get_european_station_history(**default_args))
     return data
 
 
@@ -77,13 +88,13 @@ def get_japan_station_history_wrapper(args):
     ''' Returns dict with pd.Series '''
     default_args = {"ipfs_timeout": None}
     default_args.update(args)
-    data = client.get_japan_station_history(**default_args)
+    data = coalesced_fetch(('get_japan_station_history', default_args), lambda: client.get_japan_station_history(**default_args))
     return data
 
 
 def get_tropical_storms_wrapper(args):
     ''' Returns dict with pd.DataFrame '''
-    data = client.get_tropical_storms(**args)
+    data = coalesced_fetch(('get_tropical_storms', args), lambda: client.get_tropical_storms(**args))
     return data
 
 
@@ -91,7 +102,7 @@ def get_irrigation_data_wrapper(args):
     ''' Returns dict with pd.DataFrame '''
     default_args = {"ipfs_timeout": None}
     default_args.update(args)
-    data = client.get_irrigation_data(**default_args)
+    data = coalesced_fetch(('get_irrigation_data', default_args), lambda: client.get_irrigation_data(**default_args))
     return data
 
 
@@ -103,7 +114,7 @@ def get_transitional_yield_history_wrapper(args):
         args['dataset'] = 'rma_t_yield-single-value'
     default_args = {"impute": False}
     default_args.update(args)
-    data = client.get_yield_history(**default_args)
+    data = coalesced_fetch(('get_yield_history', default_args), lambda: client.get_yield_history(**default_args))
     return data
 
 
@@ -117,7 +128,7 @@ def get_yield_history_wrapper(args):
         args['dataset'] = 'sco-yearly'
     default_args = {"impute": False, "fill": False}
     default_args.update(args)
-    data = client.get_yield_history(**default_args)
+    data = coalesced_fetch(('get_yield_history', default_args), lambda: client.get_yield_history(**default_args))
     return data
 
 
@@ -125,27 +136,34 @@ def get_station_history_wrapper(args):
     ''' Returns dict with pd.Series '''
     default_args = {"dataset": "ghcnd", "station_id": "USW00003016", "use_imperial_units": True, "desired_units": None, "ipfs_timeout": None}
     default_args.update(args)
-    data = client.get_station_history(**default_args)
-    data['data'] = pd.Series(data['data'])
-    if data.empty:
-        raise ValueError('No data returned for request')
-    data['data'] = data['data'].set_axis(pd.to_datetime(data['data'].index)).sort_index()
-    return data
+
+    def fetch():
+        data = client.get_station_history(**default_args)
+        data['data'] = pd.Series(data['data'])
+        if data['data'].empty:
+            raise ValueError('No data returned for request')
+        data['data'] = data['data'].set_axis(pd.to_datetime(data['data'].index)).sort_index()
+        return data
+
+    return HISTORY_CACHE.load(history_key_parts(get_head(default_args['dataset']), 'get_station_history', **default_args), fetch)
 
 
 def get_gridcell_history_wrapper(args):
     ''' Returns dict with pd.Series '''
     default_args = {"also_return_metadata": False, "also_return_snapped_coordinates": True, "use_imperial_units": True, "desired_units": None, "ipfs_timeout": None, "as_of": None, "convert_to_local_time": True}
     default_args.update(args)
-    data = client.get_gridcell_history(**default_args)
-    data['data'] = data['data'].set_axis(pd.to_datetime(data['data'].index, utc=True)).sort_index()
-    return data
+
+    def fetch():
+        data = client.get_gridcell_history(**default_args)
+        data['data'] = data['data'].set_axis(pd.to_datetime(data['data'].index, utc=True)).sort_index()
+        return data
+
+    return HISTORY_CACHE.load(history_key_parts(get_head(default_args['dataset']), 'get_gridcell_history', **default_args), fetch)
 
 
 def get_metadata_wrapper(args):
     ''' Returns dict '''
-    hash = client.get_heads()[args['dataset']]
-    metadata = client.get_metadata(hash)
+    hash, metadata = DATASET_HEADS.get_metadata(args['dataset'])
     if args.get('full_metadata', False):
         return metadata
     if args['dataset'] in client.GRIDDED_DATASETS.keys():
@@ -168,107 +186,23 @@ def get_metadata_wrapper(args):
     return metadata
 
 
-def get_api_mapping(file_path):
-    client_wrapper = {
-        'ceda-biomass': get_ceda_biomass_wrapper,
-        'cme-history': get_cme_station_history_wrapper,
-        'drought-monitor': get_drought_monitor_history_wrapper,
-        'dutch-station-history': get_dutch_station_history_wrapper,
-        'forecasts': get_forecasts_wrapper,
-        'german-station-history': get_german_station_history_wrapper,
-        'ghcn-history': get_station_history_wrapper,
-        'grid-history': get_gridcell_history_wrapper,
-        'irrigation_splits': get_irrigation_data_wrapper,
-        'metadata': get_metadata_wrapper,
-        'storms': get_tropical_storms_wrapper,
-        'transitional_yield': get_transitional_yield_history_wrapper,
-        'yield': get_yield_history_wrapper,
-        'japan-station-history': get_japan_station_history_wrapper
-    }
-    with open(file_path, 'r') as swagger:
-        api = json.load(swagger)
-        swagger.close()
-
-    # parse swagger and get parameters and url endpoints
-    api_map = {'basePath': api['basePath'] + '/', 'paths': {}}
-    for path in api['paths'].keys():
-        if 'user' in path or 'valid' in path or 'biomass' in path:
-            continue
-        key = path[:path.find('/{')][1:] if '/{' in path else path[1:]
-        types = {}
-        primary = re.findall(r'(?<=\{).+?(?=\})', path) if '/{' in path else []
-        secondary = []
-        for param in api['paths'][path].get('parameters', []):
-            types[param['name']] = param['type']
-        for param in api['paths'][path].get('get', {}).get('parameters', []):
-            if param['name'] != 'Authorization':
-                secondary.append(param['name'])
-                types[param['name']] = param['type']
-        api_map['paths'][key] = {'name': path, 'primary': primary, 'secondary': secondary, 'types': types, 'function': client_wrapper[key]}
+def get_api_mapping(file_path=SWAGGER_PATH):
+    ''' Returns dict, endpoint map of the swagger document with the client wrapper function of each endpoint '''
+    api_map = load_api_map(file_path)
+    for endpoint in api_map['paths'].values():
+        endpoint['function'] = globals()[endpoint['function']]
     return api_map
 
 
-API_MAP = get_api_mapping('swagger.json')
+API_MAP = get_api_mapping()
+
+
+ROUTER = Router(API_MAP)
 
 
 def parse_request(data):
-    # check basePath version
-    if not data.startswith(API_MAP['basePath']):
-        return 'Incompatible API version, please use ' + API_MAP['basePath'], False
-    request_data = data.removeprefix(API_MAP['basePath'])
-
-    # get endpoint
-    request_parsed = list(urlparse(request_data))
-    request_paths = re.split('/', request_parsed[2])
-    key = request_paths[0]
-    api_endpoint = API_MAP['paths'].get(key, None)
-    if api_endpoint is None:
-        return 'Improperly formatted request URL, endpoint not found', False
-
-    # get primary parameters
-    args = {}
-    endpoint_primaries = api_endpoint['primary']
-    endpoint_secondaries = api_endpoint['secondary']
-    if 'dataset' in endpoint_primaries:
-        params = [request_paths[1]]
-        for req in request_paths[2:]:
-            params += re.split('_', req)
-    else:
-        params = re.split('_|/', request_parsed[2])[1:]
-    if request_parsed[4] == '':
-        queries = []
-    else:
-        queries = request_parsed[4].split('&')
-    if len(params) != len(endpoint_primaries):
-        return 'Improperly formatted request URL, incompatible parameters', False
-
-    # cast floats and set primary args
-    floats = ['lat', 'lon', 'radius', 'max_lat', 'max_lon', 'min_lat', 'min_lon']
-    for i in range(len(endpoint_primaries)):
-        param = endpoint_primaries[i]
-        if param in floats:
-            args[param] = float(params[i])
-        else:
-            args[param] = params[i]
-
-    # parse secondary parameters
-    for j in range(len(queries)):
-        param = queries[j][:queries[j].find('=')]
-        value = queries[j][queries[j].find('='):][1:]
-        param_type = API_MAP['paths'][key]['types'][param]
-        if not param in endpoint_secondaries:
-            return 'Improperly formatted request URL, incompatible parameters', False
-
-        # type check parameters and set secondary args
-        if param in floats:
-            args[param] = float(params[i])
-        if param_type != 'string':
-            if param_type == 'boolean':
-                value = value.capitalize()
-            value = ast.literal_eval(value)
-        args[param] = value
-    args['_key'] = key
-    return args, True
+    ''' Returns (dict, True) of endpoint arguments or (str, False) with an error message '''
+    return ROUTER.parse(data)
 
 
 def get_request_data(args):
@@ -278,40 +212,66 @@ def get_request_data(args):
     return data
 
 
-def operate_on_data(data, ops, args):
-    ''' 
-        data is dict iff metadata and BytesIO iff CEDA (basically not supported)
-            and pd.Series/pd.DataFrame otherwise 
-        18 digits of precision on decimals 
-        times are returned as timestamps starting at beginning of unix epoch
-        dates are returned as timestamps starting at beginning of unix epoch to start of date
-        ms on timestamps
+@lru_cache(maxsize=None)
+def _timezone_finder():
+    from timezonefinder import TimezoneFinder
+    return TimezoneFinder()
+
+
+def to_local_time(series, args):
+    ''' Converts the UTC series of a located endpoint (a grid cell or forecast) back
+        to the local time of its location, which the grid history wrapper drops by
+        parsing timestamps as UTC. Other series are returned unchanged
+
+        Parameters: series (Pandas Series), time series of the endpoint
+                    args (dict), endpoint arguments of the request URL
+        Returns: Pandas Series, the series in local time where it applies
     '''
-    if type(data) is dict or type(data) is io.BytesIO:
-        return 0, "Request not supported"
-    reset = data
-    for i, op in enumerate(ops):
-        pandas_op = getattr(data, op)
-        op_params = ast.literal_eval(args[i])
-        return_result = op_params.pop(0)
-        carry_forward = op_params.pop(0)
-        result = pandas_op(*op_params)
-        if return_result:
-            if type(result) is pd.Series or type(result) is pd.DataFrame:
-                result = result.mean()
-            if type(result) is date:
-                result = datetime(result.year, result.month, result.day)
-            if type(result) is time:
-                result = datetime(0, 0, 0, result.hour, result.minute, result.second, result.microsecond)
-            if type(result) is datetime:
-                return int(result.replace(tzinfo=timezone.utc).timestamp() * 1000), None
-            elif 'float' in str(type(result)) or 'int' in str(type(result)):
-                return int(float(result) * 1e18), None
-            else:
-                return 0, "Incompatible return type"
-        if carry_forward:
-            data = result
-        else:
-            data = reset
-    return 0, "No return specified"
+    tz = series.index.tz if isinstance(series.index, pd.DatetimeIndex) else None
+    if tz is None or str(tz) != 'UTC' or 'lat' not in args or 'lon' not in args or args.get('convert_to_local_time', True) is False:
+        return series
+    local = _timezone_finder().timezone_at(lat=float(args['lat']), lng=float(args['lon']))
+    return series if local is None else series.tz_convert(local)
+
+
+def get_multi_source_data(sources, combination, freq='D', fetch_timeout=MULTI_SOURCE_FETCH_TIMEOUT):
+    ''' Fetches the data of several request URLs concurrently, aligns their series
+        on a common time index (in the local time of located endpoints) and combines
+        them into one series
+
+        Parameters: sources (list), endpoint arguments of each parsed request URL
+                    combination (str), how the series are combined, see aggregation.SOURCE_COMBINATIONS
+                    freq (str), Pandas frequency the series are aligned on or None
+                    fetch_timeout (float), seconds to wait on all fetches before failing the request
+        Returns: dict, the combined Series under key "data" and the unit of the first source
+    '''
+    executor = ThreadPoolExecutor(max_workers=len(sources))
+    try:
+        futures = [executor.submit(get_request_data, dict(args)) for args in sources]
+        done, pending = wait(futures, timeout=fetch_timeout, return_when=FIRST_EXCEPTION)
+        if pending:
+            for future in done:
+                future.result()
+            raise TimeoutError(f'Multi-source fetch exceeded {fetch_timeout} seconds')
+        results = [future.result() for future in futures]
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    for result in results:
+        if not isinstance(result.get('data', None), pd.Series):
+            raise ValueError('Multi-source requests only support time series endpoints')
+    histories = [to_local_time(result['data'], args) for result, args in zip(results, sources)]
+    combined = CPU_EXECUTOR.run('combination', combine_sources, histories, combination, freq)
+    return {'data': combined, 'unit': results[0].get('unit', 'no unit')}
+
 
+def operate_on_data(data, ops, args):
+    ''' Compiles and runs the requested chain of operations on the data, see operations.run_plan
+
+        Returns: int, encoded result of the operation marked for return (0 on failure)
+                 str, error message or None
+    '''
+    try:
+        plan = compile_plan(ops, args)
+    except ValueError as e:
+        return 0, str(e)
+    return run_plan(data, plan)
@@ -0,0 +1,10 @@
+import os
+import sys
+
+
+ADAPTER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ADAPTER_DIR)
+sys.path.insert(0, os.path.join(ADAPTER_DIR, 'dweather'))
+
+# the crypto module reads the node key on import, tests never decrypt with it
+os.environ.setdefault('NODE_PRIVATE_KEY', '{"NODE_PRIVATE_KEY": "%s"}' % ('11' * 32))
@@ -0,0 +1,76 @@
+import threading
+
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('requests')
+pytest.importorskip('dweather.dweather_client')
+
+import app
+from program_catalog.tools.bridge import AsyncBridge
+from program_catalog.tools.ledger import JobRunLedger
+from utils.stub_chainlink_node import StubChainlinkNode
+
+
+class EchoAdapter:
+    ''' Adapter answering with its request data, counting how often it runs '''
+    DEFAULT_ID = '0'
+    runs = 0
+    release = None
+
+    def __init__(self, data):
+        EchoAdapter.runs += 1
+        if EchoAdapter.release is not None:
+            EchoAdapter.release.wait(10)
+        self.result = {'jobRunID': data['id'], 'result': data['data'], 'statusCode': 200}
+        self.succeeded = True
+
+
+@pytest.fixture
+def node():
+    node = StubChainlinkNode(port=0, token='stub-token')
+    node.start()
+    yield node
+    node.stop()
+
+
+@pytest.fixture(autouse=True)
+def adapter(monkeypatch):
+    monkeypatch.setattr(app, 'BRIDGE', AsyncBridge(enabled=True, token='stub-token', callback_timeout=5, callback_retries=1))
+    monkeypatch.setattr(app, 'LEDGER', JobRunLedger(max_size=16, ttl=60, path=None))
+    EchoAdapter.runs = 0
+    EchoAdapter.release = None
+
+
+def test_async_round_trip(node):
+    data = {'id': 'run-1', 'data': {'value': 1}, 'responseURL': node.response_url('run-1')}
+    acknowledgement = app.respond(EchoAdapter, data)
+    assert acknowledgement == {'jobRunID': 'run-1', 'pending': True, 'statusCode': 200}
+
+    job_run_id, result = node.results.get(timeout=10)
+    assert job_run_id == 'run-1'
+    assert result == {'jobRunID': 'run-1', 'result': {'value': 1}, 'statusCode': 200}
+
+    # a retry after the run finished is served the recorded result without running again
+    assert app.respond(EchoAdapter, data) == result
+    assert EchoAdapter.runs == 1
+
+
+def test_retry_while_running_is_acknowledged_again(node):
+    EchoAdapter.release = threading.Event()
+    data = {'id': 'run-2', 'data': {'value': 2}, 'responseURL': node.response_url('run-2')}
+    assert app.respond(EchoAdapter, data)['pending']
+    assert app.respond(EchoAdapter, data)['pending']
+    EchoAdapter.release.set()
+
+    job_run_id, result = node.results.get(timeout=10)
+    assert job_run_id == 'run-2' and result['result'] == {'value': 2}
+    assert node.results.empty()
+    assert EchoAdapter.runs == 1
+
+
+def test_sync_without_response_url():
+    data = {'id': 'run-3', 'data': {'value': 3}}
+    assert app.respond(EchoAdapter, data) == {'jobRunID': 'run-3', 'result': {'value': 3}, 'statusCode': 200}
+    assert app.respond(EchoAdapter, data)['result'] == {'value': 3}
+    assert EchoAdapter.runs == 1
@@ -0,0 +1,89 @@
+import threading
+
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('pandas')
+pytest.importorskip('dweather.dweather_client')
+
+from program_catalog.tools import ledger as ledger_module
+from program_catalog.tools.ledger import JobRunLedger
+
+
+class Adapter:
+    pass
+
+
+def request(job_run_id='run-1', value=1):
+    return {'id': job_run_id, 'data': {'value': value}}
+
+
+def test_duplicate_job_runs_are_computed_once():
+    ledger = JobRunLedger(max_size=16, ttl=60, path=None)
+    key = ledger.key(Adapter, request())
+    release = threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        release.wait(10)
+        return {'jobRunID': 'run-1', 'result': len(calls)}, True
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(ledger.run(key, compute))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    while ledger.stats()['coalesced'] < 4:
+        threading.Event().wait(0.01)
+    assert ledger.in_flight(key)
+    release.set()
+    for thread in threads:
+        thread.join(10)
+
+    assert len(calls) == 1
+    assert results == [{'jobRunID': 'run-1', 'result': 1}] * 5
+    # a retry after the run finished is served the recorded result
+    assert ledger.run(key, compute) == {'jobRunID': 'run-1', 'result': 1}
+    assert len(calls) == 1
+
+
+def test_keys_depend_on_route_id_and_data():
+    ledger = JobRunLedger(max_size=16, ttl=60, path=None)
+    key = ledger.key(Adapter, request())
+    assert key == ledger.key(Adapter, request())
+    assert key != ledger.key(Adapter, request(job_run_id='run-2'))
+    assert key != ledger.key(Adapter, request(value=2))
+    assert ledger.key(Adapter, {'data': {'value': 1}}) is None
+
+
+def test_failed_results_are_not_recorded():
+    ledger = JobRunLedger(max_size=16, ttl=60, path=None)
+    key = ledger.key(Adapter, request())
+    assert ledger.run(key, lambda: ({'result': 'error'}, False)) == {'result': 'error'}
+    assert ledger.get(key) is None
+    assert ledger.run(key, lambda: ({'result': 'ok'}, True)) == {'result': 'ok'}
+    assert ledger.get(key) == {'result': 'ok'}
+
+
+def test_results_expire_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ledger_module.time, 'time', lambda: now[0])
+    ledger = JobRunLedger(max_size=16, ttl=60, path=None)
+    key = ledger.key(Adapter, request())
+    ledger.run(key, lambda: ({'result': 1}, True))
+    now[0] += 59
+    assert ledger.get(key) == {'result': 1}
+    now[0] += 2
+    assert ledger.get(key) is None
+    assert ledger.run(key, lambda: ({'result': 2}, True)) == {'result': 2}
+
+
+def test_results_are_written_through_to_sqlite(tmp_path):
+    path = str(tmp_path / 'ledger' / 'job_runs.sqlite')
+    key = JobRunLedger(max_size=16, ttl=60, path=path).key(Adapter, request())
+    JobRunLedger(max_size=16, ttl=60, path=path).run(key, lambda: ({'jobRunID': 'run-1', 'result': [1, 2]}, True))
+
+    # a new ledger on the same file, as in another worker or after a restart, serves the result
+    restarted = JobRunLedger(max_size=16, ttl=60, path=path)
+    assert restarted.get(key) == {'jobRunID': 'run-1', 'result': [1, 2]}
+    assert restarted.run(key, lambda: pytest.fail('recorded job run computed again')) == {'jobRunID': 'run-1', 'result': [1, 2]}
@@ -0,0 +1,60 @@
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+from program_catalog.tools.aggregation import average_series
+
+
+'''
+Compares averaging gridcell histories with pd.concat(axis=1).mean(axis=1)
+against the preallocated NumPy aggregation used by GridcellLoader
+
+usage: python3 utils/benchmark_aggregation.py [number of locations ...]
+'''
+
+
+def make_histories(n_locations, n_days=15000, missing=0.01, seed=0):
+    ''' Builds daily UTC histories with some missing values and ragged ends '''
+    rng = np.random.default_rng(seed)
+    index = pd.date_range('1981-01-01', periods=n_days, freq='D', tz='UTC')
+    histories = []
+    for _ in range(n_locations):
+        values = rng.gamma(0.5, 0.2, n_days)
+        values[rng.random(n_days) < missing] = np.nan
+        histories.append(pd.Series(values, index=index)[:n_days - int(rng.integers(0, 30))])
+    return histories
+
+
+def concat_mean(histories):
+    df = pd.concat(histories, axis=1)
+    return pd.Series(df.mean(axis=1))
+
+
+def measure(function, histories, repeat=5):
+    ''' Returns: float, best wall time in seconds; int, peak traced memory in bytes '''
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(histories)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    result = function(histories)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak, result
+
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or [4, 32, 256]
+    print(f'{"locations":>10} {"concat ms":>10} {"numpy ms":>10} {"concat MiB":>11} {"numpy MiB":>10}')
+    for n_locations in sizes:
+        histories = make_histories(n_locations)
+        concat_time, concat_peak, expected = measure(concat_mean, histories)
+        numpy_time, numpy_peak, result = measure(average_series, histories)
+        assert result.index.equals(expected.index)
+        np.testing.assert_allclose(result.values, expected.values, rtol=1e-12, equal_nan=True)
+        print(f'{n_locations:>10} {concat_time * 1e3:>10.1f} {numpy_time * 1e3:>10.1f} {concat_peak / 2**20:>11.1f} {numpy_peak / 2**20:>10.1f}')
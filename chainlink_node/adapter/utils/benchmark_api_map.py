@@ -0,0 +1,78 @@
+import os, sys
+import json
+import shutil
+import tempfile
+import statistics
+import subprocess
+
+
+'''
+Measures, in fresh interpreters, how long building the /api endpoint map takes
+by walking swagger.json (the previous import-time behavior) against loading the
+cached artifact, and optionally the full import of tools/wrapper.py with the
+artifact missing and present. Uses only the standard library
+
+usage: python3 utils/benchmark_api_map.py [number of runs] [--wrapper]
+'''
+
+
+ADAPTER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+SNIPPETS = {
+    'swagger': (
+        'from program_catalog.tools.api_map import SWAGGER_PATH, build_api_map\n'
+        'start = time.perf_counter()\n'
+        'build_api_map(open(SWAGGER_PATH, "rb").read())\n'
+    ),
+    'cached': (
+        'from program_catalog.tools.api_map import load_api_map\n'
+        'start = time.perf_counter()\n'
+        'load_api_map()\n'
+    ),
+    'wrapper': (
+        'start = time.perf_counter()\n'
+        'import program_catalog.tools.wrapper\n'
+    ),
+}
+
+
+def run(snippet, cache_path):
+    ''' Returns: float, milliseconds measured by the snippet in a fresh interpreter '''
+    code = (
+        'import sys, time, json\n'
+        f'sys.path[:0] = [{ADAPTER_DIR!r}, {os.path.join(ADAPTER_DIR, "dweather")!r}]\n'
+        + snippet +
+        'print(json.dumps((time.perf_counter() - start) * 1e3))\n'
+    )
+    env = dict(os.environ, API_MAP_CACHE=cache_path)
+    output = subprocess.run([sys.executable, '-c', code], env=env, check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def measure(snippet, cache_path, runs, keep_cache):
+    ''' Returns: float, median milliseconds over the runs '''
+    times = []
+    for _ in range(runs):
+        if not keep_cache and os.path.exists(cache_path):
+            os.remove(cache_path)
+        times.append(run(snippet, cache_path))
+    return statistics.median(times)
+
+
+if __name__ == '__main__':
+    runs = int(next((arg for arg in sys.argv[1:] if arg.isdigit()), 20))
+    directory = tempfile.mkdtemp()
+    cache_path = os.path.join(directory, 'api_map.json')
+    try:
+        print(f'median of {runs} fresh interpreters')
+        print(f'{"stage":>28} {"ms":>8}')
+        print(f'{"endpoint map from swagger":>28} {measure(SNIPPETS["swagger"], cache_path, runs, False):>8.2f}')
+        run(SNIPPETS['cached'], cache_path)
+        print(f'{"endpoint map from artifact":>28} {measure(SNIPPETS["cached"], cache_path, runs, True):>8.2f}')
+        if '--wrapper' in sys.argv:
+            print(f'{"wrapper import, no artifact":>28} {measure(SNIPPETS["wrapper"], cache_path, runs, False):>8.2f}')
+            run(SNIPPETS['cached'], cache_path)
+            print(f'{"wrapper import, artifact":>28} {measure(SNIPPETS["wrapper"], cache_path, runs, True):>8.2f}')
+    finally:
+        shutil.rmtree(directory)
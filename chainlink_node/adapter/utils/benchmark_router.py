@@ -0,0 +1,114 @@
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'dweather'))
+
+import re
+import ast
+import time
+from urllib.parse import urlparse
+
+from program_catalog.tools.router import Router
+from program_catalog.tools.wrapper import API_MAP
+
+
+'''
+Compares the previous per-request parsing of /api request URLs against the
+precompiled Router, with its parsed URL cache both cold and warm
+
+usage: python3 utils/benchmark_router.py [number of passes]
+'''
+
+
+SAMPLE_VALUES = {
+    'dataset': 'cpcc_precip_global-daily', 'lat': '41.125', 'lon': '-75.125', 'station_id': 'USW00014732',
+    'station_name': 'Tokyo', 'weather_variable': 'TMAX', 'state': 'IL', 'county': 'Cook', 'commodity': 'corn',
+    'source': 'atcf', 'basin': 'AL', 'year': '2019', 'unit': 'MgCha',
+}
+
+
+def sample_urls(api_map):
+    ''' Builds a request URL for every endpoint, setting each boolean and string query parameter '''
+    urls = []
+    for key, endpoint in api_map['paths'].items():
+        path = endpoint['name']
+        for name in endpoint['primary']:
+            path = path.replace('{' + name + '}', SAMPLE_VALUES.get(name, name))
+        queries = [f'{name}=true' if endpoint['types'][name] == 'boolean' else f'{name}=mm'
+                   for name in endpoint['secondary'] if name not in ('lat', 'lon', 'radius', 'max_lat', 'max_lon', 'min_lat', 'min_lon')]
+        urls.append(api_map['basePath'] + path[1:] + ('?' + '&'.join(queries) if queries else ''))
+    return urls
+
+
+def legacy_parse_request(data):
+    ''' parse_request as it was before the Router, kept for comparison '''
+    if not data.startswith(API_MAP['basePath']):
+        return 'Incompatible API version, please use ' + API_MAP['basePath'], False
+    request_data = data.removeprefix(API_MAP['basePath'])
+    request_parsed = list(urlparse(request_data))
+    request_paths = re.split('/', request_parsed[2])
+    key = request_paths[0]
+    api_endpoint = API_MAP['paths'].get(key, None)
+    if api_endpoint is None:
+        return 'Improperly formatted request URL, endpoint not found', False
+    args = {}
+    endpoint_primaries = api_endpoint['primary']
+    endpoint_secondaries = api_endpoint['secondary']
+    if 'dataset' in endpoint_primaries:
+        params = [request_paths[1]]
+        for req in request_paths[2:]:
+            params += re.split('_', req)
+    else:
+        params = re.split('_|/', request_parsed[2])[1:]
+    if request_parsed[4] == '':
+        queries = []
+    else:
+        queries = request_parsed[4].split('&')
+    if len(params) != len(endpoint_primaries):
+        return 'Improperly formatted request URL, incompatible parameters', False
+    floats = ['lat', 'lon', 'radius', 'max_lat', 'max_lon', 'min_lat', 'min_lon']
+    for i in range(len(endpoint_primaries)):
+        param = endpoint_primaries[i]
+        if param in floats:
+            args[param] = float(params[i])
+        else:
+            args[param] = params[i]
+    for j in range(len(queries)):
+        param = queries[j][:queries[j].find('=')]
+        value = queries[j][queries[j].find('='):][1:]
+        param_type = API_MAP['paths'][key]['types'][param]
+        if not param in endpoint_secondaries:
+            return 'Improperly formatted request URL, incompatible parameters', False
+        if param in floats:
+            args[param] = float(params[i])
+        if param_type != 'string':
+            if param_type == 'boolean':
+                value = value.capitalize()
+            value = ast.literal_eval(value)
+        args[param] = value
+    args['_key'] = key
+    return args, True
+
+
+def measure(parse, urls, passes):
+    ''' Returns: float, microseconds per parsed URL '''
+    start = time.perf_counter()
+    for _ in range(passes):
+        for url in urls:
+            parse(url)
+    return (time.perf_counter() - start) / (passes * len(urls)) * 1e6
+
+
+if __name__ == '__main__':
+    passes = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    urls = sample_urls(API_MAP)
+    router = Router(API_MAP)
+    for url in urls:
+        expected, result = legacy_parse_request(url), router.parse(url)
+        # keys containing '_' were rejected by the previous parser
+        assert result == expected or '_' in url[len(API_MAP['basePath']):].split('/')[0], (url, expected, result)
+
+    print(f'{len(urls)} endpoints, {passes} passes')
+    print(f'{"parser":>14} {"us/url":>8}')
+    print(f'{"legacy":>14} {measure(legacy_parse_request, urls, passes):>8.2f}')
+    print(f'{"router cold":>14} {measure(Router(API_MAP, max_size=0).parse, urls, passes):>8.2f}')
+    print(f'{"router cached":>14} {measure(router.parse, urls, passes):>8.2f}')
@@ -0,0 +1,79 @@
+import sys
+import json
+import time
+import queue
+import threading
+import requests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+'''
+Local stand-in for a Chainlink node for testing the async bridge mode. Sends a
+request to the adapter with a responseURL pointing at itself, prints the pending
+acknowledgement and waits for the adapter to PATCH the result back
+
+usage: python3 utils/stub_chainlink_node.py adapter_url request_data [port] [token]
+
+e.g.   python3 utils/stub_chainlink_node.py http://127.0.0.1:8000/api '{"request_url": "/apiv3/grid-history/chirpsc_final_25-daily/13.34126091_103.39190674", "request_ops": ["mean"], "request_params": ["[True, False]"]}'
+
+start the adapter with ASYNC_BRIDGE=true and BRIDGE_INCOMING_TOKEN set to the same token (default "stub-token")
+'''
+
+
+class StubChainlinkNode:
+    ''' Minimal HTTP server accepting job run results at /v2/resume/{jobRunID}
+        the way a Chainlink node does, and handing them to the caller
+    '''
+    def __init__(self, port=6689, token='stub-token'):
+        ''' Parameters: port (int), port to listen on, 0 for any free port
+                        token (str), bearer token expected on results or None to accept any
+        '''
+        self.token = token
+        self.results = queue.Queue()
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self.port = self._server.server_address[1]
+
+    def response_url(self, job_run_id):
+        return f'http://127.0.0.1:{self.port}/v2/resume/{job_run_id}'
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler(self):
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_PATCH(self):
+                if node.token is not None and self.headers.get('Authorization') != f'Bearer {node.token}':
+                    self.send_response(401)
+                    self.end_headers()
+                    return
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                node.results.put((self.path.rsplit('/', 1)[-1], json.loads(body)))
+                self.send_response(200)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+if __name__ == '__main__':
+    adapter_url, request_data = sys.argv[1], json.loads(sys.argv[2])
+    port = int(sys.argv[3]) if len(sys.argv) > 3 else 6689
+    token = sys.argv[4] if len(sys.argv) > 4 else 'stub-token'
+    node = StubChainlinkNode(port, token)
+    node.start()
+    job_run_id = 'stub-' + str(int(time.time()))
+    start = time.perf_counter()
+    acknowledgement = requests.post(adapter_url, json={'id': job_run_id, 'data': request_data, 'responseURL': node.response_url(job_run_id)}).json()
+    print(f'acknowledged in {time.perf_counter() - start:.3f}s: {acknowledgement}')
+    if acknowledgement.get('pending'):
+        resumed_id, result = node.results.get(timeout=600)
+        print(f'result for {resumed_id} after {time.perf_counter() - start:.3f}s: {result}')
+    node.stop()